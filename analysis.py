@@ -1,9 +1,28 @@
+import os
 import librosa
 import numpy as np
+import soxr
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Tuple
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
-async def analyze_audio(audio_path: Path) -> Tuple[float, str, float]:
+ANALYSIS_SR = 22050  # SR נמוך יותר לביצועים
+
+# פרמטרי STFT משותפים - אותם ערכים כמו ברירות המחדל של onset_strength ו-chroma_stft
+N_FFT = 2048
+HOP_LENGTH = 512
+
+# מספר התהליכים לניתוח batch (ברירת מחדל: כל הליבות)
+ANALYSIS_BATCH_WORKERS = int(os.getenv("ANALYSIS_BATCH_WORKERS", "0")) or os.cpu_count() or 1
+
+# ניתוח הדרגתי: אורך חלון לעקומת tempo/key ואורך בלוק הקריאה מהקובץ
+ANALYSIS_WINDOW_SEC = float(os.getenv("ANALYSIS_WINDOW_SEC", "10"))
+ANALYSIS_BLOCK_SEC = 5.0
+TEMPOGRAM_WIN_LENGTH = 384  # ברירת המחדל של librosa (~8.9 שניות)
+
+NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+def analyze_audio(audio_path: Path) -> Tuple[float, str, float]:
     """
     ניתוח שמע לחישוב BPM, Key ומשך
     """
@@ -11,14 +30,29 @@ async def analyze_audio(audio_path: Path) -> Tuple[float, str, float]:
         print(f"מנתח קובץ שמע: {audio_path.name}")
         
         # טעינת השמע
-        y, sr = librosa.load(str(audio_path), sr=22050)  # SR נמוך יותר לביצועים
+        y, sr = librosa.load(str(audio_path), sr=ANALYSIS_SR)
+        return analyze_signal(y, sr)
+        
+    except Exception as e:
+        print(f"שגיאה בניתוח השמע: {str(e)}")
+        # ערכי ברירת מחדל במקרה של שגיאה
+        return 120.0, "C major", 180.0
+
+def analyze_signal(y: np.ndarray, sr: int) -> Tuple[float, str, float]:
+    """
+    ניתוח BPM, Key ומשך על אות mono שכבר פוענח
+    """
+    try:
         duration = librosa.get_duration(y=y, sr=sr)
         
+        # STFT אחד משותף ל-onset ול-chroma
+        onset_envelope, chroma = compute_features(y, sr)
+        
         # חישוב BPM
-        bpm = estimate_bpm(y, sr)
+        bpm = bpm_from_onset(onset_envelope, sr)
         
         # זיהוי מפתח מוזיקלי
-        key = estimate_key(y, sr)
+        key = key_from_chroma(chroma)
         
         print(f"ניתוח הושלם: BPM={bpm}, Key={key}, Duration={duration:.1f}s")
         return bpm, key, duration
@@ -28,6 +62,19 @@ async def analyze_audio(audio_path: Path) -> Tuple[float, str, float]:
         # ערכי ברירת מחדל במקרה של שגיאה
         return 120.0, "C major", 180.0
 
+def compute_features(y: np.ndarray, sr: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    onset envelope ו-chromagram מ-STFT יחיד (power spectrogram)
+    זהה לחישוב הנפרד של onset_strength(y=...) ו-chroma_stft(y=...) בלי STFT כפול
+    """
+    S = np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH)) ** 2
+    
+    mel = librosa.feature.melspectrogram(S=S, sr=sr)
+    onset_envelope = librosa.onset.onset_strength(S=librosa.power_to_db(mel), sr=sr, hop_length=HOP_LENGTH)
+    
+    chroma = librosa.feature.chroma_stft(S=S, sr=sr, n_fft=N_FFT, hop_length=HOP_LENGTH)
+    return onset_envelope, chroma
+
 def estimate_bpm(y: np.ndarray, sr: int) -> float:
     """
     חישוב BPM באמצעות beat tracking
@@ -35,26 +82,42 @@ def estimate_bpm(y: np.ndarray, sr: int) -> float:
     try:
         # חישוב onset strength
         onset_envelope = librosa.onset.onset_strength(y=y, sr=sr)
+        return bpm_from_onset(onset_envelope, sr)
         
+    except Exception as e:
+        print(f"שגיאה בחישוב BPM: {str(e)}")
+        return 120.0
+
+def bpm_from_onset(onset_envelope: np.ndarray, sr: int) -> float:
+    """
+    BPM מ-onset envelope שכבר חושב
+    """
+    try:
         # Beat tracking
         tempo, beats = librosa.beat.beat_track(
             onset_envelope=onset_envelope, 
             sr=sr,
             units='time'
         )
+        # גרסאות librosa חדשות מחזירות מערך בגודל 1
+        tempo = float(np.atleast_1d(tempo)[0])
         
-        # וידוא שה-BPM בטווח סביר
-        if tempo < 60:
-            tempo *= 2
-        elif tempo > 200:
-            tempo /= 2
-        
-        return float(tempo)
+        return fold_tempo(tempo)
         
     except Exception as e:
         print(f"שגיאה בחישוב BPM: {str(e)}")
         return 120.0
 
+def fold_tempo(tempo: float) -> float:
+    """
+    וידוא שה-BPM בטווח סביר
+    """
+    if tempo < 60:
+        tempo *= 2
+    elif tempo > 200:
+        tempo /= 2
+    return float(tempo)
+
 def estimate_key(y: np.ndarray, sr: int) -> str:
     """
     זיהוי מפתח מוזיקלי באמצעות chromagram
@@ -62,26 +125,37 @@ def estimate_key(y: np.ndarray, sr: int) -> str:
     try:
         # חישוב chromagram
         chroma = librosa.feature.chroma_stft(y=y, sr=sr)
+        return key_from_chroma(chroma)
         
+    except Exception as e:
+        print(f"שגיאה בזיהוי מפתח: {str(e)}")
+        return "C major"
+
+def key_from_chroma(chroma: np.ndarray) -> str:
+    """
+    מפתח מ-chromagram שכבר חושב
+    """
+    try:
         # חישוב ממוצע על פני הזמן
         chroma_mean = np.mean(chroma, axis=1)
-        
-        # הגדרת שמות התווים
-        note_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-        
-        # מציאת התו הדומיננטי
-        dominant_note_idx = np.argmax(chroma_mean)
-        dominant_note = note_names[dominant_note_idx]
-        
-        # זיהוי מודוס (major/minor) - אלגוריתם פשוט
-        mode = estimate_mode(chroma_mean)
-        
-        return f"{dominant_note} {mode}"
+        return key_from_profile(chroma_mean)
         
     except Exception as e:
         print(f"שגיאה בזיהוי מפתח: {str(e)}")
         return "C major"
 
+def key_from_profile(chroma_mean: np.ndarray) -> str:
+    """
+    מפתח מפרופיל כרומטי ממוצע (12 ערכים)
+    """
+    # מציאת התו הדומיננטי
+    dominant_note = NOTE_NAMES[int(np.argmax(chroma_mean))]
+    
+    # זיהוי מודוס (major/minor) - אלגוריתם פשוט
+    mode = estimate_mode(chroma_mean)
+    
+    return f"{dominant_note} {mode}"
+
 def estimate_mode(chroma_profile: np.ndarray) -> str:
     """
     זיהוי מודוס (major/minor) על בסיס פרופיל כרומטי
@@ -107,6 +181,196 @@ def estimate_mode(chroma_profile: np.ndarray) -> str:
         print(f"שגיאה בזיהוי מודוס: {str(e)}")
         return "major"
 
+class StreamingAnalyzer:
+    """
+    ניתוח BPM/Key הדרגתי: מקבל בלוקים של שמע ושומר רק סטטיסטיקות רצות של onset ו-chroma
+    מפיק עקומת tempo/key לכל חלון וגם הערכה גלובלית, בזיכרון קבוע ללא תלות באורך השיר
+    """
+
+    def __init__(
+        self,
+        input_sr: int = ANALYSIS_SR,
+        window_sec: float = ANALYSIS_WINDOW_SEC,
+        on_window: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ):
+        self.sr = ANALYSIS_SR
+        self.window_frames = max(1, int(round(window_sec * self.sr / HOP_LENGTH)))
+        self.on_window = on_window
+        self._resampler = soxr.ResampleStream(input_sr, self.sr, 1, dtype="float32") if input_sr != self.sr else None
+        
+        # filterbanks קבועים במקום chroma_stft/melspectrogram על כל השיר
+        self._mel_basis = librosa.filters.mel(sr=self.sr, n_fft=N_FFT)
+        self._chroma_basis = librosa.filters.chroma(sr=self.sr, n_fft=N_FFT)
+        
+        self._buffer = np.zeros(0, dtype=np.float32)  # דגימות שעוד לא נכנסו לפריים שלם
+        self._prev_mel_db: Optional[np.ndarray] = None
+        self._samples = 0
+        
+        # החלון הנוכחי (לכל היותר window_frames פריימים)
+        self._window_onset: List[np.ndarray] = []
+        self._window_chroma = np.zeros(12)
+        self._window_len = 0
+        self._window_start = 0
+        
+        # סטטיסטיקות גלובליות
+        self._chroma_sum = np.zeros(12)
+        self._tempogram_sum = np.zeros(TEMPOGRAM_WIN_LENGTH)
+        self._frames = 0
+        self.timeline: List[Dict[str, Any]] = []
+
+    def feed(self, block: np.ndarray) -> None:
+        """
+        בלוק שמע (channels, samples) או mono ב-input_sr
+        """
+        mono = block.mean(axis=0) if block.ndim > 1 else block
+        mono = mono.astype(np.float32, copy=False)
+        if self._resampler is not None:
+            mono = self._resampler.resample_chunk(mono)
+        self._push(mono)
+
+    def _push(self, samples: np.ndarray) -> None:
+        self._samples += len(samples)
+        buffer = np.concatenate([self._buffer, samples])
+        n_frames = 1 + (len(buffer) - N_FFT) // HOP_LENGTH if len(buffer) >= N_FFT else 0
+        if n_frames <= 0:
+            self._buffer = buffer
+            return
+        
+        used = (n_frames - 1) * HOP_LENGTH + N_FFT
+        S = np.abs(librosa.stft(buffer[:used], n_fft=N_FFT, hop_length=HOP_LENGTH, center=False)) ** 2
+        self._buffer = buffer[n_frames * HOP_LENGTH:]
+        
+        # onset strength: שינוי חיובי ממוצע בין פריימים של mel בדציבלים (כמו onset_strength עם lag=1)
+        mel_db = librosa.power_to_db(self._mel_basis @ S, top_db=None)
+        prev = mel_db[:, :1] if self._prev_mel_db is None else self._prev_mel_db
+        onset = np.maximum(0.0, np.diff(np.concatenate([prev, mel_db], axis=1), axis=1)).mean(axis=0)
+        self._prev_mel_db = mel_db[:, -1:]
+        
+        chroma = librosa.util.normalize(self._chroma_basis @ S, norm=np.inf, axis=0)
+        
+        # חלוקה לחלונות
+        pos = 0
+        while pos < n_frames:
+            take = min(n_frames - pos, self.window_frames - self._window_len)
+            self._window_onset.append(onset[pos:pos + take])
+            self._window_chroma += chroma[:, pos:pos + take].sum(axis=1)
+            self._window_len += take
+            pos += take
+            if self._window_len == self.window_frames:
+                self._close_window()
+
+    def _close_window(self) -> None:
+        onset = np.concatenate(self._window_onset)
+        tempogram = librosa.feature.tempogram(
+            onset_envelope=onset, sr=self.sr, hop_length=HOP_LENGTH, win_length=TEMPOGRAM_WIN_LENGTH
+        )
+        tempogram_mean = tempogram.mean(axis=1)
+        
+        window = {
+            "start_sec": round(self._window_start * HOP_LENGTH / self.sr, 2),
+            "end_sec": round((self._window_start + self._window_len) * HOP_LENGTH / self.sr, 2),
+            "bpm": round(self._tempo(tempogram_mean), 1),
+            "key": key_from_profile(self._window_chroma / self._window_len),
+        }
+        self.timeline.append(window)
+        if self.on_window is not None:
+            self.on_window(window)
+        
+        self._tempogram_sum += tempogram_mean * self._window_len
+        self._chroma_sum += self._window_chroma
+        self._frames += self._window_len
+        
+        self._window_start += self._window_len
+        self._window_onset = []
+        self._window_chroma = np.zeros(12)
+        self._window_len = 0
+
+    def _tempo(self, tempogram_mean: np.ndarray) -> float:
+        tempo = librosa.feature.tempo(tg=tempogram_mean[:, np.newaxis], sr=self.sr, hop_length=HOP_LENGTH)
+        return fold_tempo(float(np.atleast_1d(tempo)[0]))
+
+    def finish(self) -> Dict[str, Any]:
+        """
+        סגירת החלון האחרון והחזרת ההערכה הגלובלית ועקומת החלונות
+        """
+        if self._resampler is not None:
+            self._push(self._resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True))
+            self._resampler = None
+        if self._window_len:
+            self._close_window()
+        
+        duration = self._samples / self.sr
+        if not self._frames:
+            return {"bpm": 120.0, "key": "C major", "duration_sec": duration, "timeline": []}
+        return {
+            "bpm": self._tempo(self._tempogram_sum / self._frames),
+            "key": key_from_profile(self._chroma_sum / self._frames),
+            "duration_sec": duration,
+            "timeline": self.timeline,
+        }
+
+def analyze_array(audio: np.ndarray, sr: int, block_sec: float = ANALYSIS_BLOCK_SEC) -> Dict[str, Any]:
+    """
+    ניתוח הדרגתי של מערך שכבר פוענח (channels, samples) - בלוקים בלי עותק mono מלא
+    """
+    analyzer = StreamingAnalyzer(input_sr=sr)
+    block_size = int(block_sec * sr)
+    for start in range(0, audio.shape[-1], block_size):
+        analyzer.feed(audio[..., start:start + block_size])
+    return analyzer.finish()
+
+def analyze_file(path: Union[str, Path]) -> Dict[str, Any]:
+    """
+    ניתוח קובץ יחיד עבור analyze_batch (רץ בתהליך נפרד)
+    """
+    try:
+        y, sr = librosa.load(str(path), sr=ANALYSIS_SR)
+        duration = librosa.get_duration(y=y, sr=sr)
+        onset_envelope, chroma = compute_features(y, sr)
+        return {
+            "path": str(path),
+            "bpm": bpm_from_onset(onset_envelope, sr),
+            "key": key_from_chroma(chroma),
+            "duration_sec": duration,
+            "ok": True,
+        }
+    except Exception as e:
+        print(f"שגיאה בניתוח {path}: {str(e)}")
+        return {"path": str(path), "bpm": np.nan, "key": None, "duration_sec": np.nan, "ok": False}
+
+def analyze_batch(
+    paths: Sequence[Union[str, Path]],
+    max_workers: Optional[int] = None,
+    as_arrow: bool = False,
+):
+    """
+    ניתוח BPM/Key/משך לרשימת קבצים ב-process pool
+    מחזיר תוצאה עמודתית: dict של מערכי NumPy (path, bpm, key, duration_sec, ok),
+    או pyarrow.Table כש-as_arrow=True
+    """
+    paths = [str(p) for p in paths]
+    workers = min(max_workers or ANALYSIS_BATCH_WORKERS, len(paths)) or 1
+    
+    if workers == 1:
+        rows = [analyze_file(p) for p in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(analyze_file, paths, chunksize=max(1, len(paths) // (workers * 4))))
+    
+    columns = {
+        "path": np.array([r["path"] for r in rows], dtype=object),
+        "bpm": np.array([r["bpm"] for r in rows], dtype=np.float32),
+        "key": np.array([r["key"] for r in rows], dtype=object),
+        "duration_sec": np.array([r["duration_sec"] for r in rows], dtype=np.float32),
+        "ok": np.array([r["ok"] for r in rows], dtype=bool),
+    }
+    
+    if as_arrow:
+        import pyarrow as pa
+        return pa.table({name: pa.array(list(values) if values.dtype == object else values)
+                         for name, values in columns.items()})
+    return columns
+
 def analyze_harmonic_content(y: np.ndarray, sr: int) -> dict:
     """
     ניתוח הרמוני מתקדם (לעתיד)
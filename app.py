@@ -1,20 +1,32 @@
 import os
+import asyncio
 import uuid
 import shutil
+import hashlib
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, Any
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import FileResponse
+from email.utils import formatdate
+from typing import Any, Dict, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import torch
 
-from separate import separate_audio
-from postprocess import postprocess_stems
-from analysis import analyze_audio
+from cache import ResultCache
+from encode import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, media_type_for, stem_filename
+from engine import DEVICE, get_engine
+from jobs import JobQueue, QueueFullError
+from metrics import HTTP_REQUESTS, HTTP_SECONDS, REGISTRY, SERVED_BYTES, CpuSampler, Gauge, read_rss_bytes
+from pipeline import SEPARATION_SR, STEM_NAMES, read_job_meta, run_pipeline
+from preview import ensure_preview, read_excerpt, read_peaks
+from progressive import STREAM_DIR, stream_part_path, tail_stem_stream
+from quality import AUTO, COST_MODEL, DEFAULT_PROFILE, QUALITY_PROFILES, validate_quality
+from storage import StorageManager
+from uploads import UploadError, check_content_length, receive_upload
 
 # זיהוי סביבת הרצה
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 IS_RUNPOD = os.getenv("RUNPOD_POD_ID") is not None
 IS_CLOUD = IS_RUNPOD or os.getenv("CLOUD_PROVIDER") is not None
 
@@ -37,7 +49,32 @@ else:
     MAX_DURATION = 10 * 60  # 10 דקות מקומי
     CORS_ORIGINS = ["http://localhost:3000", "http://127.0.0.1:3000"]
 
-app = FastAPI(title="musicRay API", version="1.0.0")
+SUPPORTED_EXTENSIONS = ('.mp3', '.wav', '.flac', '.m4a')
+
+# הגשת קבצים - תוצרי job לא משתנים, לכן cache ארוך
+FILE_CHUNK_SIZE = 1024 * 1024  # 1MB
+FILE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# sendfile דרך reverse proxy: X-Accel-Redirect (nginx) או X-Sendfile (Apache/lighttpd)
+SENDFILE_HEADER = os.getenv("SENDFILE_HEADER")
+SENDFILE_PREFIX = os.getenv("SENDFILE_PREFIX", "/protected-storage/")  # internal location של nginx
+SENDFILE_MIN_BYTES = int(os.getenv("SENDFILE_MIN_BYTES", str(1024 * 1024)))
+
+# אורך שיר טיפוסי להערכת זמן עבודה ב-/system-info לפני שנמדדו עבודות
+TYPICAL_TRACK_SEC = float(os.getenv("TYPICAL_TRACK_SEC", "240"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    טעינת מודל ההפרדה פעם אחת בעליית השרת, והפעלת ניקוי ה-storage ברקע
+    """
+    app.state.engine = get_engine()
+    sweeper = asyncio.create_task(storage.run_sweeper())
+    yield
+    sweeper.cancel()
+    job_queue.shutdown()
+
+app = FastAPI(title="musicRay API", version="1.0.0", lifespan=lifespan)
 
 # הגדרת CORS לחיבור עם Frontend
 app.add_middleware(
@@ -52,102 +89,402 @@ app.add_middleware(
 STORAGE_DIR = Path("storage")
 STORAGE_DIR.mkdir(exist_ok=True)
 
-@app.post("/upload")
-async def upload_audio(file: UploadFile = File(...)) -> Dict[str, Any]:
+# תור העבודות - worker pool מוגבל
+job_queue = JobQueue()
+
+# מטמון תוצאות לפי תוכן הקובץ
+result_cache = ResultCache(STORAGE_DIR / "_cache")
+
+# TTL, מכסה ופינוי LRU של תיקיות ה-jobs - מצב של job שנמחק מוסר גם מהתור,
+# וכשפינוי jobs לא מספיק (הסטמים מקושרים למטמון) מפנים גם מהמטמון
+storage = StorageManager(STORAGE_DIR, on_delete=job_queue.forget, reclaim=result_cache.evict)
+
+# מדדים שנקראים בכל scrape של /metrics
+Gauge("musicray_queue_depth", "Jobs waiting in the queue", fn=job_queue.queued_count)
+Gauge("musicray_jobs_running", "Jobs currently processing", fn=job_queue.running_count)
+Gauge("musicray_storage_bytes", "Bytes used under storage/ (unique inodes) as of the last sweep", fn=lambda: storage.usage()["total_bytes"])
+Gauge("musicray_gpu_memory_allocated_bytes", "GPU memory allocated by tensors",
+      fn=lambda: torch.cuda.memory_allocated() if DEVICE == "cuda" else None)
+Gauge("musicray_gpu_memory_reserved_bytes", "GPU memory reserved by the caching allocator",
+      fn=lambda: torch.cuda.memory_reserved() if DEVICE == "cuda" else None)
+Gauge("musicray_gpu_memory_free_bytes", "Free GPU memory reported by the driver",
+      fn=lambda: torch.cuda.mem_get_info()[0] if DEVICE == "cuda" else None)
+
+# ניצול CPU של התהליך בין קריאות ל-/system-info
+cpu_sampler = CpuSampler()
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
     """
-    העלאת קובץ שמע והפרדה לסטמים
+    ספירת בקשות וזמן תגובה לפי תבנית ה-route (לא לפי ה-path המלא - בלי job_id ב-labels)
     """
+    start = time.perf_counter()
+    status = 500
     try:
-        # בדיקת גודל קובץ
-        contents = await file.read()
-        if len(contents) > MAX_FILE_SIZE:
-            raise HTTPException(status_code=413, detail="הקובץ גדול מדי (מקסימום 100MB)")
-        
-        # בדיקת סוג קובץ
-        if not file.filename or not file.filename.lower().endswith(('.mp3', '.wav', '.flac', '.m4a')):
-            raise HTTPException(status_code=400, detail="פורמט קובץ לא נתמך. השתמש ב-MP3, WAV, FLAC או M4A")
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        HTTP_REQUESTS.inc(method=request.method, route=path, status=status)
+        HTTP_SECONDS.observe(time.perf_counter() - start, route=path)
+
+# תיאור הטופס ב-OpenAPI - הגוף נקרא בזרימה ולא דרך פרמטרי File/Form
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file"],
+                    "properties": {
+                        "file": {"type": "string", "format": "binary"},
+                        "output_format": {"type": "string", "enum": list(OUTPUT_FORMATS), "default": DEFAULT_OUTPUT_FORMAT},
+                        "progressive": {"type": "boolean", "default": False},
+                        "quality": {"type": "string", "default": AUTO},
+                    },
+                }
+            }
+        },
+    }
+}
+
+@app.post("/upload", status_code=202, openapi_extra=UPLOAD_OPENAPI)
+async def upload_audio(request: Request) -> Dict[str, Any]:
+    """
+    העלאת קובץ שמע והכנסת עבודת הפרדה לתור
+    output_format - פורמט הסטמים: wav (float), wav16, flac, opus, mp3
+    progressive - הזרמת הסטמים בזמן ההפרדה דרך /jobs/{job_id}/stream/{stem}
+    quality - fast / balanced / best, או auto (בחירה לפי עומס ואורך השיר)
+    """
+    try:
+        # דחייה לפי Content-Length - לפני קריאת הגוף
+        check_content_length(request, MAX_FILE_SIZE)
         
-        # יצירת job_id ייחודי
+        # יצירת job_id ייחודי - pinned עד סוף העיבוד כדי שהניקוי לא ימחק אותו
         job_id = str(uuid.uuid4())
+        storage.pin(job_id)
         job_dir = STORAGE_DIR / job_id
         job_dir.mkdir(exist_ok=True)
         
-        # שמירת הקובץ המקורי
-        input_path = job_dir / f"input{Path(file.filename).suffix}"
-        with open(input_path, "wb") as f:
-            f.write(contents)
+        # קליטת הטופס בזרימה - הקובץ נכתב ישר ל-job_dir, סיומת וגודל נבדקים לפני/תוך כדי הכתיבה
+        upload = await receive_upload(request, job_dir, MAX_FILE_SIZE, SUPPORTED_EXTENSIONS)
+        input_path, content_hash = upload.path, upload.content_hash
+        
+        output_format = upload.fields.get("output_format", DEFAULT_OUTPUT_FORMAT).lower()
+        if output_format not in OUTPUT_FORMATS:
+            raise HTTPException(status_code=400, detail=f"פורמט פלט לא נתמך. נתמכים: {', '.join(OUTPUT_FORMATS)}")
         
-        print(f"מתחיל עיבוד job {job_id} עבור קובץ {file.filename}")
+        try:
+            quality = validate_quality(upload.fields.get("quality", AUTO))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        # המרה ל-WAV והפרדה
-        stems_paths = await separate_audio(input_path, job_dir)
+        progressive = upload.fields.get("progressive", "false").strip().lower() in ("1", "true", "on", "yes")
         
-        # Post-processing לכל סטם
-        processed_stems = await postprocess_stems(stems_paths)
+        # תיקיית הזרם נוצרת מראש כדי שלקוחות יוכלו להתחבר עוד לפני שהעבודה התחילה
+        if progressive:
+            (job_dir / STREAM_DIR).mkdir()
         
-        # ניתוח BPM ו-Key
-        bpm, key, duration = await analyze_audio(input_path)
+        def process(job):
+            try:
+                return run_pipeline(
+                    job, input_path, job_dir, MAX_DURATION, content_hash, result_cache,
+                    output_format, progressive, quality, job_queue.queued_count
+                )
+            finally:
+                storage.unpin(job_id)
         
-        # בדיקת משך השיר
-        if duration > MAX_DURATION:
-            # נקה קבצים ותחזיר שגיאה
-            shutil.rmtree(job_dir, ignore_errors=True)
-            raise HTTPException(status_code=413, detail=f"השיר ארוך מדי ({duration/60:.1f} דקות). מקסימום 10 דקות")
+        # הכנסה לתור - העיבוד רץ ב-worker מחוץ ל-event loop
+        job = job_queue.submit(job_id, upload.filename, process)
         
-        # הכנת התשובה
         response = {
             "job_id": job_id,
-            "stems": {
-                "vocals": f"/files/{job_id}/vocals.wav",
-                "drums": f"/files/{job_id}/drums.wav", 
-                "bass": f"/files/{job_id}/bass.wav",
-                "other": f"/files/{job_id}/other.wav"
-            },
-            "bpm": int(bpm),
-            "key": key,
-            "duration_sec": round(duration, 1)
+            "status": job.status,
+            "output_format": output_format,
+            "quality": quality,
+            "status_url": f"/jobs/{job_id}",
+            "result_url": f"/jobs/{job_id}/result"
         }
-        
-        print(f"הושלם עיבוד job {job_id}: BPM={bpm}, Key={key}, Duration={duration:.1f}s")
+        if progressive:
+            response["stream_urls"] = {name: f"/jobs/{job_id}/stream/{name}" for name in STEM_NAMES}
         return response
         
     except HTTPException:
+        if 'job_dir' in locals():
+            await asyncio.to_thread(shutil.rmtree, job_dir, ignore_errors=True)
+            storage.unpin(job_id)
         raise
+    except UploadError as e:
+        if 'job_dir' in locals():
+            await asyncio.to_thread(shutil.rmtree, job_dir, ignore_errors=True)
+            storage.unpin(job_id)
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except QueueFullError as e:
+        if 'job_dir' in locals():
+            await asyncio.to_thread(shutil.rmtree, job_dir, ignore_errors=True)
+            storage.unpin(job_id)
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        print(f"שגיאה בעיבוד: {str(e)}")
+        print(f"שגיאה בקליטת הקובץ: {str(e)}")
         # ניקוי במקרה של שגיאה
         if 'job_dir' in locals():
-            shutil.rmtree(job_dir, ignore_errors=True)
-        raise HTTPException(status_code=500, detail=f"שגיאה בעיבוד השיר: {str(e)}")
+            await asyncio.to_thread(shutil.rmtree, job_dir, ignore_errors=True)
+            storage.unpin(job_id)
+        raise HTTPException(status_code=500, detail=f"שגיאה בקליטת השיר: {str(e)}")
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str) -> Dict[str, Any]:
+    """
+    מצב והתקדמות של עבודה
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job לא נמצא")
+    return job.to_dict()
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """
+    תוצאת העבודה - 202 כל עוד העיבוד לא הסתיים
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job לא נמצא")
+    if job.status == "failed":
+        raise HTTPException(status_code=job.error_status or 500, detail=job.error)
+    if job.status != "done":
+        return JSONResponse(status_code=202, content=job.to_dict())
+    storage.touch(job_id)
+    return job.result
+
+@app.get("/jobs/{job_id}/stream/{stem}")
+async def stream_stem(job_id: str, stem: str):
+    """
+    הזרמת סטם (WAV PCM16, chunked) בזמן שההפרדה מתקדמת - לעבודות שנשלחו עם progressive
+    הזרם הוא פלט ההפרדה הגולמי; הקבצים הסופיים (אחרי post-processing) ב-/files
+    """
+    job = job_queue.get(job_id)
+    stream_dir = STORAGE_DIR / job_id / STREAM_DIR
+    if job is None or stem not in STEM_NAMES or not stream_dir.is_dir():
+        raise HTTPException(status_code=404, detail="זרם לא נמצא")
+    if job.status == "failed":
+        raise HTTPException(status_code=job.error_status or 500, detail=job.error)
+    
+    # תוצאה מהמטמון, או זרם שנמחק אחרי סיום העבודה - מפנים לקובץ הסופי
+    if job.status == "done" and not stream_part_path(stream_dir, stem).exists():
+        return RedirectResponse(job.result["stems"][stem])
+    
+    storage.touch(job_id)
+    return StreamingResponse(
+        tail_stem_stream(stream_dir, stem, SEPARATION_SR),
+        media_type="audio/wav",
+        headers={"Cache-Control": "no-store"}
+    )
+
+def resolve_stem_file(job_id: str, filename: str) -> Path:
+    """
+    נתיב קובץ סטם בתוך תיקיית ה-job - 404 לכל דבר אחר (קובץ הקלט, מטמון, path traversal)
+    """
+    storage_root = STORAGE_DIR.resolve()
+    job_dir = (STORAGE_DIR / job_id).resolve()
+    file_path = (job_dir / filename).resolve()
+    if (
+        job_dir.parent != storage_root
+        or file_path.parent != job_dir
+        or job_id.startswith(("_", "."))
+        or filename.startswith("input")
+        or media_type_for(filename) == "application/octet-stream"
+        or not file_path.is_file()
+    ):
+        raise HTTPException(status_code=404, detail="הקובץ לא נמצא")
+    return file_path
+
+def file_etag(file_path: Path, stat: os.stat_result) -> str:
+    """
+    ETag חזק - נגזר ממפתח התוכן של ה-job (hash הקלט + פרמטרים + פורמט) ושם הקובץ
+    ללא מטא-דאטה (jobs ישנים) - נגזר מגודל וזמן שינוי
+    """
+    meta = read_job_meta(file_path.parent)
+    if meta is not None:
+        base = f"{meta['cache_key']}:{file_path.name}"
+    else:
+        base = f"{file_path.name}:{stat.st_size}:{stat.st_mtime_ns}"
+    return f'"{hashlib.sha256(base.encode("utf-8")).hexdigest()[:32]}"'
+
+def etag_matches(header: str, etag: str) -> bool:
+    """
+    השוואה חלשה של If-None-Match מול ה-ETag (כולל רשימה, W/ ו-*)
+    """
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    טווח בתים יחיד (start, end כולל) מתוך Range
+    None - header לא תקין או multi-range (מוגש הקובץ המלא), ValueError - טווח מחוץ לקובץ
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_str, sep, end_str = spec.strip().partition("-")
+    start_str, end_str = start_str.strip(), end_str.strip()
+    if not sep or not (start_str or end_str) or not all(part.isdigit() for part in (start_str, end_str) if part):
+        return None
+    
+    if not start_str:
+        # suffix range - N הבתים האחרונים
+        length = int(end_str)
+        if length == 0 or size == 0:
+            raise ValueError("טווח ריק")
+        return max(size - length, 0), size - 1
+    
+    start = int(start_str)
+    end = int(end_str) if end_str else size - 1
+    if end_str and end < start:
+        return None
+    if start >= size:
+        raise ValueError("טווח מחוץ לקובץ")
+    return start, min(end, size - 1)
+
+def iter_file_range(file_path: Path, start: int, end: int):
+    """
+    קריאת טווח מהקובץ בחלקים (רץ ב-threadpool של Starlette)
+    """
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(FILE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
 
-@app.get("/files/{job_id}/{filename}")
-async def get_file(job_id: str, filename: str):
+@app.api_route("/files/{job_id}/{filename}", methods=["GET", "HEAD"])
+async def get_file(job_id: str, filename: str, request: Request):
     """
-    הורדת קובץ סטם
+    הורדת קובץ סטם - Range (206), ETag/If-None-Match (304) ו-cache ארוך
+    קבצי job לא משתנים, לכן CDN ודפדפן יכולים לשמור אותם לתמיד
     """
     try:
-        file_path = STORAGE_DIR / job_id / filename
-        if not file_path.exists():
-            raise HTTPException(status_code=404, detail="הקובץ לא נמצא")
-        
-        return FileResponse(
-            path=str(file_path),
-            media_type="audio/wav",
-            filename=filename
+        file_path = resolve_stem_file(job_id, filename)
+        storage.touch(job_id)
+        stat = file_path.stat()
+        size = stat.st_size
+        etag = file_etag(file_path, stat)
+        
+        headers = {
+            "ETag": etag,
+            "Cache-Control": FILE_CACHE_CONTROL,
+            "Accept-Ranges": "bytes",
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        }
+        
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        
+        # offload ל-reverse proxy (nginx/Apache) - הקובץ נשלח ב-sendfile וה-proxy מטפל ב-Range
+        if SENDFILE_HEADER and size >= SENDFILE_MIN_BYTES:
+            if SENDFILE_HEADER.lower() == "x-accel-redirect":
+                headers[SENDFILE_HEADER] = f"{SENDFILE_PREFIX}{job_id}/{filename}"
+            else:
+                headers[SENDFILE_HEADER] = str(file_path)
+            headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+            return Response(media_type=media_type_for(filename), headers=headers)
+        
+        # Range מתעלמים ממנו אם If-Range לא תואם את הגרסה הנוכחית - השוואה חזקה (RFC 9110), בלי W/
+        byte_range = None
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header and (not if_range or if_range.strip() == etag):
+            try:
+                byte_range = parse_range(range_header, size)
+            except ValueError:
+                return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        
+        if byte_range is None:
+            if request.method == "GET":
+                SERVED_BYTES.inc(size, route="files")
+            return FileResponse(
+                path=str(file_path),
+                media_type=media_type_for(filename),
+                filename=filename,
+                headers=headers,
+                stat_result=stat
+            )
+        
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        if request.method == "HEAD":
+            return Response(status_code=206, media_type=media_type_for(filename), headers=headers)
+        SERVED_BYTES.inc(end - start + 1, route="files")
+        return StreamingResponse(
+            iter_file_range(file_path, start, end),
+            status_code=206,
+            media_type=media_type_for(filename),
+            headers=headers
         )
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"שגיאה בהורדת קובץ {job_id}/{filename}: {str(e)}")
         raise HTTPException(status_code=500, detail="שגיאה בהורדת הקובץ")
 
+def resolve_preview(job_id: str, stem: str, pcm: bool = False) -> Path:
+    """
+    תיקיית job שהושלם עם קבצי התצוגה של הסטם (נבנים מהסטם הסופי אם חסרים) - 404 אחרת
+    pcm - גם עותק ה-PCM לקטעים (נבנה בבקשת הקטע הראשונה)
+    """
+    job_dir = (STORAGE_DIR / job_id).resolve()
+    meta = None
+    if job_dir.parent == STORAGE_DIR.resolve() and not job_id.startswith(("_", ".")) and stem in STEM_NAMES:
+        meta = read_job_meta(job_dir)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="סטם לא נמצא")
+    stem_file = job_dir / stem_filename(stem, meta["output_format"])
+    if not stem_file.is_file():
+        raise HTTPException(status_code=404, detail="סטם לא נמצא")
+    storage.touch(job_id)
+    ensure_preview(job_dir, stem, stem_file, pcm)
+    return job_dir
+
+@app.get("/jobs/{job_id}/excerpt/{stem}")
+async def get_excerpt(job_id: str, stem: str, start: float = 0.0, end: Optional[float] = None):
+    """
+    קטע קצר מהסטם (WAV PCM16) לפי זמן בשניות - נקרא מ-memmap בלי לגעת בשאר הקובץ
+    """
+    job_dir = await asyncio.to_thread(resolve_preview, job_id, stem, True)
+    try:
+        data = await asyncio.to_thread(read_excerpt, job_dir, stem, start, end)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    SERVED_BYTES.inc(len(data), route="excerpt")
+    return Response(content=data, media_type="audio/wav", headers={"Cache-Control": FILE_CACHE_CONTROL})
+
+@app.get("/jobs/{job_id}/peaks/{stem}")
+async def get_peaks(job_id: str, stem: str, width: int = 1000, start: float = 0.0, end: Optional[float] = None):
+    """
+    waveform של הסטם ברוחב width פיקסלים (min/max לכל פיקסל) מפירמידת ה-peaks
+    """
+    job_dir = await asyncio.to_thread(resolve_preview, job_id, stem)
+    try:
+        peaks = await asyncio.to_thread(read_peaks, job_dir, stem, width, start, end)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content=peaks, headers={"Cache-Control": FILE_CACHE_CONTROL})
+
 @app.delete("/files/{job_id}")
 async def delete_job(job_id: str):
     """
-    מחיקת כל קבצי ה-job
+    מחיקת כל קבצי ה-job (ב-thread - מחיקה גדולה לא חוסמת את ה-event loop)
     """
     try:
-        job_dir = STORAGE_DIR / job_id
-        if job_dir.exists():
-            shutil.rmtree(job_dir)
+        if await asyncio.to_thread(storage.delete, job_id):
             return {"message": f"נמחקו כל קבצי job {job_id}"}
         else:
             raise HTTPException(status_code=404, detail="Job לא נמצא")
@@ -157,6 +494,30 @@ async def delete_job(job_id: str):
         print(f"שגיאה במחיקת job {job_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="שגיאה במחיקת הקבצים")
 
+@app.get("/jobs/{job_id}/trace")
+async def get_job_trace(job_id: str) -> Dict[str, Any]:
+    """
+    פירוק זמני העבודה: span לכל שלב (התחלה יחסית, משך, thread ומאפיינים)
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job לא נמצא")
+    return {**job.to_dict(), "trace": job.trace.to_dict()}
+
+@app.get("/metrics")
+async def metrics():
+    """
+    מדדים בפורמט הטקסט של Prometheus
+    """
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/storage")
+async def storage_usage():
+    """
+    שימוש בדיסק של storage: בתים מול מכסה, jobs, מקום פנוי ותוצאות הניקוי ברקע
+    """
+    return storage.usage()
+
 @app.get("/health")
 async def health_check():
     """
@@ -167,16 +528,63 @@ async def health_check():
 @app.get("/system-info")
 async def system_info():
     """
-    מידע על המערכת והביצועים
+    מידע על המערכת ועל העומס הנוכחי - GPU, CPU, workers, תור והמתנה משוערת
+    לשימוש load balancer בבחירת replica להעלאה
     """
     gpu_info = {}
     if DEVICE == "cuda":
+        free, total = torch.cuda.mem_get_info()
         gpu_info = {
             "gpu_name": torch.cuda.get_device_name(),
-            "gpu_memory_total": f"{torch.cuda.get_device_properties(0).total_memory / 1e9:.1f}GB",
-            "gpu_memory_available": f"{torch.cuda.get_device_properties(0).total_memory / 1e9:.1f}GB"
+            "gpu_memory_total": f"{total / 1e9:.1f}GB",
+            "gpu_memory_available": f"{free / 1e9:.1f}GB",
+            "memory_total_bytes": total,
+            "memory_free_bytes": free,
+            "memory_allocated_bytes": torch.cuda.memory_allocated(),
+            "memory_reserved_bytes": torch.cuda.memory_reserved(),
+            "memory_max_allocated_bytes": torch.cuda.max_memory_allocated(),
         }
-    
+        try:
+            gpu_info["utilization_percent"] = torch.cuda.utilization()
+        except Exception:
+            gpu_info["utilization_percent"] = None  # דורש pynvml
+
+    cpu_count = os.cpu_count() or 1
+    try:
+        load_avg = [round(load, 2) for load in os.getloadavg()]
+    except OSError:
+        load_avg = None
+    cpu_info = {
+        "cpu_count": cpu_count,
+        "load_avg": load_avg,
+        "process_cpu_percent": cpu_sampler.percent(),
+        "process_rss_bytes": read_rss_bytes(),
+    }
+
+    running = job_queue.running_count()
+    queued = job_queue.queued_count()
+    wait = job_queue.estimated_wait(COST_MODEL.estimate(TYPICAL_TRACK_SEC, QUALITY_PROFILES[DEFAULT_PROFILE]["shifts"]))
+    usage = storage.usage()
+    workers = {
+        "busy": running,
+        "total": job_queue.max_workers,
+        "occupancy": round(running / job_queue.max_workers, 2),
+    }
+    queue = {
+        "length": queued,
+        "max_size": job_queue.max_queue_size,
+        "service_sec": round(job_queue.service_sec, 1) if job_queue.service_sec is not None else None,
+    }
+    capacity = {
+        "accepting_jobs": queued < job_queue.max_queue_size,
+        "free_workers": max(job_queue.max_workers - running, 0),
+        "queue_slots_free": max(job_queue.max_queue_size - queued, 0),
+        "estimated_wait_sec": wait,
+        "gpu_memory_free_bytes": gpu_info.get("memory_free_bytes"),
+        "disk_free_bytes": usage["disk_free_bytes"],
+        "storage_quota_used": usage["quota_used"],
+    }
+
     return {
         "device": DEVICE,
         "is_cloud": IS_CLOUD,
@@ -184,6 +592,11 @@ async def system_info():
         "max_file_size_mb": MAX_FILE_SIZE // (1024 * 1024),
         "max_duration_minutes": MAX_DURATION // 60,
         "gpu_info": gpu_info,
+        "cpu_info": cpu_info,
+        "workers": workers,
+        "queue": queue,
+        "estimated_wait_sec": wait,
+        "capacity": capacity,
         "performance_tier": "high" if DEVICE == "cuda" else "standard"
     }
 
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+"""
+musicRay - benchmark לביצועי העיבוד
+מודד זמן wall, זמן CPU, זיכרון שיא (RSS) וזיכרון GPU לכל שלב בצינור
+ומדפיס JSON להשוואה בין גרסאות והגדרות (shifts/overlap/segment)
+
+דוגמאות:
+    python benchmark.py pipeline --durations 30 120 600 1200
+    python benchmark.py pipeline --input song.mp3 --shifts 2 --output run.json
+    python benchmark.py pipeline --compare baseline.json
+    MUSICRAY_DEVICE=cpu python benchmark.py pipeline --durations 30
+    python benchmark.py postprocess --durations 30 180
+    python benchmark.py throughput --jobs 4 --duration 120 --batch-sizes 1 4 8
+    python benchmark.py precision --input reference.wav --precisions fp16 bf16 int8
+    python benchmark.py analysis --files 32 --duration 180 --workers 1 4 8
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+
+from metrics import read_rss_bytes
+from postprocess import process_stem_fused, process_stem_staged
+
+SR = 44100
+STEM_TYPES = ["vocals", "drums", "bass", "other"]
+DEFAULT_DURATIONS = [30, 120, 600, 1200]
+
+
+def synth_stereo(duration_sec: float, sr: int = SR, seed: int = 0) -> np.ndarray:
+    """
+    אות stereo סינתטי (טונים + רעש) בצורה (2, samples) ב-float32
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration_sec * sr), dtype=np.float32) / sr
+    tone = 0.3 * np.sin(2 * np.pi * 110 * t) + 0.2 * np.sin(2 * np.pi * 440 * t)
+    noise = 0.05 * rng.standard_normal((2, t.shape[0]), dtype=np.float32)
+    return (noise + tone).astype(np.float32)
+
+
+def synth_song(duration_sec: float, sr: int = SR, seed: int = 0) -> np.ndarray:
+    """
+    "שיר" סינתטי עם תופים, בס ומלודיה - כדי ש-Demucs והניתוח יעבדו על תוכן דומה למוזיקה
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration_sec * sr)
+    t = np.arange(n, dtype=np.float32) / sr
+
+    beat = 60.0 / 120  # 120 BPM
+    phase = (t % beat) / beat
+    kick = np.sin(2 * np.pi * 55 * t) * np.exp(-phase * 30)
+    hats = rng.standard_normal(n).astype(np.float32) * np.exp(-((t + beat / 2) % beat) / beat * 60) * 0.1
+    bass = 0.3 * np.sin(2 * np.pi * 55 * t * (1 + (np.floor(t / (4 * beat)) % 2) * 0.5))
+    melody = 0.2 * np.sin(2 * np.pi * 440 * t * (1 + (np.floor(t / beat) % 4) / 8))
+
+    mono = (0.5 * kick + hats + bass + melody).astype(np.float32)
+    return np.stack([mono, np.roll(mono, 3)]) * 0.7
+
+
+class RSSSampler:
+    """
+    דגימת RSS ב-thread רקע למציאת שיא הזיכרון בזמן שלב
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak = max(self.peak, read_rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "RSSSampler":
+        self.peak = read_rss_bytes()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, read_rss_bytes())
+
+
+def _cuda():
+    """
+    torch.cuda אם זמין ובשימוש, אחרת None
+    """
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return torch.cuda
+    except ImportError:
+        pass
+    return None
+
+
+def measure(fn: Callable[..., Any], *args, trace_alloc: bool = False) -> Tuple[Any, Dict[str, float]]:
+    """
+    הרצת פונקציה ומדידת זמן wall, זמן CPU, שיא RSS וזיכרון GPU
+    trace_alloc=True מוסיף שיא הקצאות numpy (tracemalloc) - מאט את הריצה
+    """
+    cuda = _cuda()
+    if cuda is not None:
+        cuda.synchronize()
+        cuda.reset_peak_memory_stats()
+
+    rss_before = read_rss_bytes()
+    if trace_alloc:
+        tracemalloc.start()
+
+    with RSSSampler() as sampler:
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = fn(*args)
+        if cuda is not None:
+            cuda.synchronize()
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+
+    stats = {
+        "wall_sec": round(wall, 4),
+        "cpu_sec": round(cpu, 4),
+        "peak_rss_mb": round(sampler.peak / 1024 / 1024, 1),
+        "rss_delta_mb": round((sampler.peak - rss_before) / 1024 / 1024, 1),
+    }
+    if trace_alloc:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats["peak_alloc_mb"] = round(peak / 1024 / 1024, 1)
+    if cuda is not None:
+        stats["gpu_peak_mb"] = round(cuda.max_memory_allocated() / 1024 / 1024, 1)
+    return result, stats
+
+
+def bench_postprocess(durations: List[float], repeats: int) -> List[Dict[str, Any]]:
+    """
+    השוואת שרשרת ה-post-processing המקורית מול המנוע המאוחד
+    """
+    implementations = {"staged": process_stem_staged, "fused": process_stem_fused}
+    results = []
+
+    for duration in durations:
+        source = synth_stereo(duration)
+        for stem_type in STEM_TYPES:
+            for impl_name, impl in implementations.items():
+                runs = []
+                for _ in range(repeats):
+                    _, stats = measure(impl, source.copy(), SR, stem_type, trace_alloc=True)
+                    runs.append(stats)
+
+                best = min(runs, key=lambda r: r["wall_sec"])
+                results.append({
+                    "stage": "postprocess",
+                    "impl": impl_name,
+                    "stem": stem_type,
+                    "duration_sec": duration,
+                    **best,
+                })
+                print(f"{impl_name:>6} {stem_type:>6} {duration:>6.0f}s: "
+                      f"{best['wall_sec']:.3f}s wall, {best['cpu_sec']:.3f}s cpu, {best['peak_alloc_mb']}MB")
+
+    return results
+
+
+class _BenchJob:
+    """
+    Job מינימלי עבור run_pipeline מחוץ לתור העבודות
+    """
+
+    def __init__(self, job_id: str, filename: str):
+        from metrics import Trace
+
+        self.job_id = job_id
+        self.filename = filename
+        self.trace = Trace()
+
+    def update(self, stage: str, progress: float) -> None:
+        pass
+
+
+def bench_pipeline(
+    clips: List[Tuple[str, Path]],
+    params: Dict[str, Any],
+    work_dir: Path,
+    quality: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    מדידת כל שלב בנפרד (פענוח, הפרדה, post-processing, ניתוח) ושל הצינור המלא
+    """
+    from analysis import analyze_audio
+    from engine import get_engine
+    from pipeline import run_pipeline
+    from postprocess import postprocess_stems
+    from quality import DEFAULT_PROFILE
+    from separate import decode_audio, separate_array
+
+    # טעינת המודל מחוץ למדידה - כמו בשרת, שבו הוא נטען פעם אחת
+    _, load_stats = measure(get_engine)
+    results = [{"stage": "model_load", "clip": None, **load_stats}]
+
+    for clip_name, clip_path in clips:
+        duration = sf.info(str(clip_path)).duration
+        clip_dir = work_dir / clip_name
+        clip_dir.mkdir(parents=True, exist_ok=True)
+
+        def record(stage: str, stats: Dict[str, float]) -> None:
+            results.append({"stage": stage, "clip": clip_name, "duration_sec": round(duration, 1), **stats})
+            print(f"{stage:>12} {clip_name:>12}: {stats['wall_sec']:8.2f}s wall, "
+                  f"{stats['cpu_sec']:8.2f}s cpu, {stats['peak_rss_mb']:8.1f}MB rss")
+
+        audio, stats = measure(decode_audio, clip_path)
+        record("decode", stats)
+
+        stems, stats = measure(separate_array, audio, params)
+        record("separate", stats)
+        del audio
+
+        stems_paths = {}
+        for stem_name, stem_audio in stems.items():
+            stems_paths[stem_name] = clip_dir / f"{stem_name}.wav"
+            sf.write(str(stems_paths[stem_name]), stem_audio.T, SR, subtype='FLOAT')
+        del stems
+
+        _, stats = measure(postprocess_stems, stems_paths)
+        record("postprocess", stats)
+
+        _, stats = measure(analyze_audio, clip_path)
+        record("analyze", stats)
+
+        job_dir = work_dir / f"{clip_name}-e2e"
+        job_dir.mkdir(exist_ok=True)
+        job = _BenchJob(clip_name, clip_path.name)
+        _, stats = measure(run_pipeline, job, clip_path, job_dir, float("inf"), clip_name, None,
+                           quality=quality or DEFAULT_PROFILE)
+        stats["spans"] = {span["name"]: span["duration_sec"] for span in job.trace.to_dict()["spans"]}
+        record("end_to_end", stats)
+
+        shutil.rmtree(clip_dir, ignore_errors=True)
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+    return results
+
+
+def bench_throughput(jobs: int, duration: float, batch_sizes: List[int], params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    תפוקה (שירים לשעה) של jobs עבודות הפרדה במקביל, עם ובלי batching בין בקשות
+    """
+    from engine import SegmentBatcher, get_engine
+
+    engine = get_engine()
+    songs = [synth_song(duration, seed=i) for i in range(jobs)]
+
+    def run(audio: np.ndarray) -> None:
+        engine.separate(audio, shifts=params["shifts"], overlap=params["overlap"], segment=params["segment"])
+
+    results = []
+    for batch_size in batch_sizes:
+        engine.batcher = SegmentBatcher(engine, batch_size=batch_size) if batch_size > 1 else None
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            _, stats = measure(lambda: list(pool.map(run, songs)))
+
+        result = {
+            "stage": "throughput",
+            "impl": f"batch{batch_size}",
+            "batch_size": batch_size,
+            "jobs": jobs,
+            "duration_sec": duration,
+            "songs_per_hour": round(jobs * 3600 / stats["wall_sec"], 1),
+            **stats,
+        }
+        if engine.batcher is not None:
+            result.update(engine.batcher.stats())
+        results.append(result)
+        print(f"batch={batch_size:>3}: {result['songs_per_hour']:8.1f} songs/hour ({stats['wall_sec']:.1f}s wall)")
+
+    return results
+
+
+def sdr(reference: np.ndarray, estimate: np.ndarray) -> float:
+    """
+    Signal-to-Distortion Ratio (dB) של estimate מול reference
+    """
+    noise = float(np.sum((reference - estimate) ** 2))
+    signal = float(np.sum(reference ** 2))
+    return round(10 * np.log10((signal + 1e-12) / (noise + 1e-12)), 2)
+
+
+def bench_precision(audio: np.ndarray, precisions: List[str], params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    זמן, זיכרון ו-SDR לכל סטם בכל דיוק, מול פלט fp32 של אותו קליפ
+    (shifts=0 כברירת מחדל - כך ההבדל נובע רק מהדיוק ולא מהזזות אקראיות)
+    """
+    from engine import SeparatorEngine
+
+    def run(engine: "SeparatorEngine") -> Dict[str, np.ndarray]:
+        return engine.separate(audio, shifts=params["shifts"], overlap=params["overlap"], segment=params["segment"])
+
+    engine = SeparatorEngine(precision="fp32")
+    reference, stats = measure(run, engine)
+    results = [{"stage": "precision", "impl": "fp32", "sdr_mean_db": None, **stats}]
+    del engine
+
+    for precision in precisions:
+        engine = SeparatorEngine(precision=precision)
+        stems, stats = measure(run, engine)
+        scores = {name: sdr(reference[name], stems[name]) for name in reference}
+        results.append({
+            "stage": "precision",
+            "impl": engine.precision,
+            "sdr_db": scores,
+            "sdr_mean_db": round(float(np.mean(list(scores.values()))), 2),
+            **stats,
+        })
+        print(f"{engine.precision:>5}: SDR מול fp32 {results[-1]['sdr_mean_db']:6.1f}dB, "
+              f"{stats['wall_sec']:.1f}s wall (fp32 {results[0]['wall_sec']:.1f}s)")
+        del engine
+
+    return results
+
+
+def bench_analysis(paths: List[Path], workers: List[int]) -> List[Dict[str, Any]]:
+    """
+    תפוקת ניתוח BPM/Key (קבצים לשנייה) של analyze_batch לכל מספר תהליכים
+    """
+    from analysis import analyze_batch
+
+    results = []
+    for n in workers:
+        columns, stats = measure(analyze_batch, paths, n)
+        result = {
+            "stage": "analysis",
+            "impl": f"workers{n}",
+            "workers": n,
+            "files": len(paths),
+            "failed": int((~columns["ok"]).sum()),
+            "files_per_sec": round(len(paths) / stats["wall_sec"], 2),
+            **stats,
+        }
+        results.append(result)
+        print(f"workers={n:>3}: {result['files_per_sec']:8.2f} files/sec ({stats['wall_sec']:.1f}s wall)")
+
+    return results
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str) -> None:
+    """
+    הדפסת שינוי באחוזים מול ריצת בסיס שמורה
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+
+    def key(r: Dict[str, Any]) -> Tuple:
+        return r["stage"], r.get("clip"), r.get("impl"), r.get("stem")
+
+    base_by_key = {key(r): r for r in baseline}
+    print("\nהשוואה מול baseline:")
+    for r in results:
+        base = base_by_key.get(key(r))
+        if base is None:
+            continue
+        changes = []
+        for metric in ("wall_sec", "cpu_sec", "peak_rss_mb", "gpu_peak_mb"):
+            if metric in r and base.get(metric):
+                changes.append(f"{metric} {100 * (r[metric] - base[metric]) / base[metric]:+.1f}%")
+        print(f"  {r['stage']:>12} {str(r.get('clip') or ''):>12}: {', '.join(changes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="musicRay benchmark")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    pl = subparsers.add_parser("pipeline", help="זמנים לכל שלב ולצינור המלא")
+    pl.add_argument("--durations", type=float, nargs="+", default=DEFAULT_DURATIONS,
+                    help="אורכי קליפים סינתטיים בשניות")
+    pl.add_argument("--input", type=str, nargs="*", default=[], help="קבצי שמע אמיתיים במקום קליפים סינתטיים")
+    pl.add_argument("--quality", type=str, default=None, choices=["fast", "balanced", "best"])
+    pl.add_argument("--shifts", type=int, default=None)
+    pl.add_argument("--overlap", type=float, default=None)
+    pl.add_argument("--segment", type=float, default=None)
+
+    pp = subparsers.add_parser("postprocess", help="השוואת post-processing: staged מול fused")
+    pp.add_argument("--durations", type=float, nargs="+", default=[30, 180])
+    pp.add_argument("--repeats", type=int, default=3)
+
+    tp = subparsers.add_parser("throughput", help="תפוקה של עבודות במקביל עם batching בין בקשות")
+    tp.add_argument("--jobs", type=int, default=4, help="מספר עבודות במקביל")
+    tp.add_argument("--duration", type=float, default=120, help="אורך כל שיר סינתטי בשניות")
+    tp.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    tp.add_argument("--quality", type=str, default=None, choices=["fast", "balanced", "best"])
+    tp.add_argument("--shifts", type=int, default=None)
+    tp.add_argument("--overlap", type=float, default=None)
+    tp.add_argument("--segment", type=float, default=None)
+
+    pr = subparsers.add_parser("precision", help="השוואת דיוק (fp16/bf16/int8) מול fp32 - זמן, זיכרון ו-SDR")
+    pr.add_argument("--input", type=str, default=None, help="קליפ ייחוס (ברירת מחדל: קליפ סינתטי)")
+    pr.add_argument("--duration", type=float, default=30, help="אורך הקליפ הסינתטי/החיתוך בשניות")
+    pr.add_argument("--precisions", type=str, nargs="+", default=["fp16", "bf16", "int8"])
+    pr.add_argument("--shifts", type=int, default=0)
+    pr.add_argument("--overlap", type=float, default=0.25)
+    pr.add_argument("--segment", type=float, default=None)
+
+    an = subparsers.add_parser("analysis", help="תפוקת ניתוח BPM/Key ב-batch לפי מספר תהליכים")
+    an.add_argument("--input", type=str, nargs="*", default=[], help="קבצי שמע אמיתיים במקום קליפים סינתטיים")
+    an.add_argument("--files", type=int, default=16, help="מספר קליפים סינתטיים")
+    an.add_argument("--duration", type=float, default=60, help="אורך כל קליפ סינתטי בשניות")
+    an.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+
+    for sub in (pl, pp, tp, pr, an):
+        sub.add_argument("--output", type=str, default=None, help="קובץ JSON לשמירת התוצאות")
+        sub.add_argument("--compare", type=str, default=None, help="קובץ JSON של ריצת בסיס להשוואה")
+
+    args = parser.parse_args()
+    report: Dict[str, Any] = {"command": args.command, "timestamp": time.time(), "host": platform.node()}
+
+    if args.command == "pipeline":
+        from engine import DEVICE
+        from separate import get_separation_params
+
+        params = get_separation_params(args.quality)
+        for name in ("shifts", "overlap", "segment"):
+            if getattr(args, name) is not None:
+                params[name] = getattr(args, name)
+        report.update({"device": DEVICE, "params": params})
+
+        work_dir = Path(tempfile.mkdtemp(prefix="musicray-bench-"))
+        try:
+            clips = [(Path(p).stem, Path(p)) for p in args.input]
+            if not clips:
+                for duration in args.durations:
+                    clip_path = work_dir / f"synth_{int(duration)}s.wav"
+                    sf.write(str(clip_path), synth_song(duration).T, SR, subtype='PCM_16')
+                    clips.append((clip_path.stem, clip_path))
+            results = bench_pipeline(clips, params, work_dir, args.quality)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    elif args.command == "postprocess":
+        results = bench_postprocess(args.durations, args.repeats)
+
+    elif args.command == "throughput":
+        from engine import DEVICE
+        from separate import get_separation_params
+
+        params = get_separation_params(args.quality)
+        for name in ("shifts", "overlap", "segment"):
+            if getattr(args, name) is not None:
+                params[name] = getattr(args, name)
+        report.update({"device": DEVICE, "params": params})
+        results = bench_throughput(args.jobs, args.duration, args.batch_sizes, params)
+
+    elif args.command == "precision":
+        from engine import DEVICE
+        from separate import decode_audio
+
+        if args.input:
+            audio = decode_audio(Path(args.input))[:, :int(args.duration * SR)]
+        else:
+            audio = synth_song(args.duration)
+        params = {"shifts": args.shifts, "overlap": args.overlap, "segment": args.segment}
+        report.update({"device": DEVICE, "params": params, "clip": args.input or "synthetic"})
+        results = bench_precision(audio, args.precisions, params)
+
+    elif args.command == "analysis":
+        work_dir = Path(tempfile.mkdtemp(prefix="musicray-bench-"))
+        try:
+            paths = [Path(p) for p in args.input]
+            if not paths:
+                for i in range(args.files):
+                    clip_path = work_dir / f"synth_{i}.wav"
+                    sf.write(str(clip_path), synth_song(args.duration, seed=i).T, SR, subtype='PCM_16')
+                    paths.append(clip_path)
+            results = bench_analysis(paths, args.workers)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report["results"] = results
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+musicRay - מטמון תוצאות לפי תוכן (content-addressed)
+מפתח = SHA-256 של הקובץ שהועלה + פרמטרי ההפרדה
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# הגבלות המטמון
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(20 * 1024 * 1024 * 1024)))  # 20GB
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "500"))
+
+ENTRY_FILE = "entry.json"
+
+
+def hash_file(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """
+    חישוב SHA-256 של קובץ בקריאה בחלקים
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_cache_key(content_hash: str, params: Dict[str, Any]) -> str:
+    """
+    מפתח מטמון מ-hash התוכן ופרמטרי ההפרדה
+    """
+    payload = json.dumps({"content": content_hash, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    """
+    hard link כשאפשר (מיידי, בלי שכפול דיסק), אחרת העתקה
+    """
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ResultCache:
+    """
+    מטמון תוצאות על דיסק עם פינוי LRU לפי גודל ומספר רשומות
+    """
+
+    def __init__(self, root: Path, max_bytes: int = CACHE_MAX_BYTES, max_entries: int = CACHE_MAX_ENTRIES):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def _entry_dir(self, key: str) -> Path:
+        return self.root / key
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        החזרת רשומת המטמון (files + result) או None
+        """
+        entry_file = self._entry_dir(key) / ENTRY_FILE
+        try:
+            with open(entry_file, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        entry_dir = self._entry_dir(key)
+        if not all((entry_dir / name).exists() for name in entry["files"]):
+            return None
+
+        # עדכון זמן גישה אחרון עבור LRU
+        try:
+            os.utime(entry_file, None)
+        except OSError:
+            return None  # הרשומה פונתה בינתיים
+        entry["dir"] = str(entry_dir)
+        return entry
+
+    def restore(self, key: str, dest_dir: Path) -> Optional[Dict[str, Any]]:
+        """
+        שחזור קבצי התוצאה לתיקיית job והחזרת התוצאה השמורה
+        """
+        entry = self.lookup(key)
+        if entry is None:
+            return None
+
+        entry_dir = Path(entry["dir"])
+        restored = []
+        try:
+            for name in entry["files"]:
+                link_or_copy(entry_dir / name, dest_dir / name)
+                restored.append(name)
+        except OSError as e:
+            # הרשומה פונתה בין lookup לשחזור - נחשב כהחטאה, בלי קבצים חלקיים ב-job
+            print(f"אזהרה: שחזור מהמטמון נכשל ({str(e)}), ממשיך בלי מטמון")
+            for name in restored:
+                try:
+                    (dest_dir / name).unlink()
+                except OSError:
+                    pass
+            return None
+
+        print(f"⚡ נמצא במטמון: {key[:12]}")
+        return entry["result"]
+
+    def store(self, key: str, src_dir: Path, files: List[str], result: Dict[str, Any]) -> None:
+        """
+        שמירת קבצי תוצאה ותוצאת הניתוח במטמון
+        """
+        try:
+            entry_dir = self._entry_dir(key)
+            if entry_dir.exists():
+                return
+
+            # כתיבה לתיקייה זמנית ו-rename אטומי
+            tmp_dir = self.root / f".tmp-{uuid.uuid4().hex}"
+            tmp_dir.mkdir()
+            for name in files:
+                link_or_copy(Path(src_dir) / name, tmp_dir / name)
+            with open(tmp_dir / ENTRY_FILE, "w", encoding="utf-8") as f:
+                json.dump({"files": files, "result": result, "created_at": time.time()}, f, ensure_ascii=False)
+
+            try:
+                tmp_dir.rename(entry_dir)
+            except OSError:
+                # עבודה מקבילה כבר שמרה את אותו מפתח
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+            self.evict()
+
+        except Exception as e:
+            print(f"אזהרה: שמירה במטמון נכשלה: {str(e)}")
+
+    def evict(self, reclaim_bytes: int = 0) -> int:
+        """
+        פינוי הרשומות הישנות ביותר (LRU) עד שהמטמון בגבולות,
+        ובנוסף רשומות בגודל reclaim_bytes לפחות (לחץ דיסק ב-storage) - מחזיר את הבתים שהתפנו בפועל
+        קבצים שמקושרים (hard link) גם מתיקיית job לא מתפנים עכשיו, אבל ה-job כבר לא חולק אותם עם המטמון
+        """
+        with self._lock:
+            entries = []
+            for entry_dir in self.root.iterdir():
+                if entry_dir.name.startswith("."):
+                    continue
+                entry_file = entry_dir / ENTRY_FILE
+                try:
+                    stats = [p.stat() for p in entry_dir.iterdir() if p.is_file()]
+                    mtime = entry_file.stat().st_mtime
+                except OSError:
+                    continue
+                size = sum(st.st_size for st in stats)
+                freeable = sum(st.st_size for st in stats if st.st_nlink <= 1)
+                entries.append((mtime, size, freeable, entry_dir))
+
+            entries.sort()
+            total = sum(entry[1] for entry in entries)
+            freed = reclaimed = 0
+            while entries and (total > self.max_bytes or len(entries) > self.max_entries or reclaimed < reclaim_bytes):
+                _, size, freeable, entry_dir = entries.pop(0)
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                total -= size
+                reclaimed += size
+                freed += freeable
+                print(f"🧹 פונה מהמטמון: {entry_dir.name[:12]}")
+            return freed
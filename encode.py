@@ -0,0 +1,134 @@
+"""
+musicRay - קידוד סטמים לפורמט הפלט (WAV / FLAC / Opus / MP3)
+הקידוד רץ ב-worker pool - libsndfile משחרר את ה-GIL בזמן הקידוד
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict
+
+import numpy as np
+import soundfile as sf
+import soxr
+
+from metrics import timed
+
+# פורמטי פלט נתמכים: סיומת, container/subtype של libsndfile, media type ו-SR (אם הפורמט מחייב)
+OUTPUT_FORMATS: Dict[str, Dict[str, Any]] = {
+    "wav": {"ext": "wav", "format": "WAV", "subtype": "FLOAT", "media_type": "audio/wav"},
+    "wav16": {"ext": "wav", "format": "WAV", "subtype": "PCM_16", "media_type": "audio/wav"},
+    "flac": {"ext": "flac", "format": "FLAC", "subtype": "PCM_16", "media_type": "audio/flac"},
+    "opus": {"ext": "opus", "format": "OGG", "subtype": "OPUS", "media_type": "audio/ogg", "samplerate": 48000},
+    "mp3": {"ext": "mp3", "format": "MP3", "subtype": "MPEG_LAYER_III", "media_type": "audio/mpeg"},
+}
+
+# ברירת המחדל נשארת WAV float כמו קודם - לקוחות קיימים לא מושפעים
+DEFAULT_OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "wav")
+
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", "4"))
+
+encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="musicray-encode")
+
+MEDIA_TYPES = {spec["ext"]: spec["media_type"] for spec in OUTPUT_FORMATS.values()}
+
+
+def get_output_format(name: str) -> Dict[str, Any]:
+    """
+    הגדרות הפורמט לפי שם - ValueError לפורמט לא נתמך
+    """
+    try:
+        return OUTPUT_FORMATS[name]
+    except KeyError:
+        raise ValueError(f"פורמט פלט לא נתמך: {name}. נתמכים: {', '.join(OUTPUT_FORMATS)}")
+
+
+def stem_filename(stem_name: str, output_format: str) -> str:
+    return f"{stem_name}.{get_output_format(output_format)['ext']}"
+
+
+def media_type_for(filename: str) -> str:
+    """
+    media type לפי סיומת הקובץ
+    """
+    return MEDIA_TYPES.get(Path(filename).suffix.lstrip(".").lower(), "application/octet-stream")
+
+
+def _prepare(audio: np.ndarray, spec: Dict[str, Any]) -> np.ndarray:
+    """
+    פורמטים שלמים ודחוסים - חיתוך ל-[-1, 1] (libsndfile לא חותך בעצמו)
+    """
+    if spec["subtype"] == "FLOAT":
+        return audio
+    return np.clip(audio, -1.0, 1.0)
+
+
+def write_stem(audio: np.ndarray, sr: int, output_path: Path, output_format: str) -> Path:
+    """
+    קידוד סטם (channels, samples) מהזיכרון לקובץ בפורמט המבוקש
+    """
+    spec = get_output_format(output_format)
+    with timed("encode"):
+        frames = audio.T
+        target_sr = spec.get("samplerate", sr)
+        if target_sr != sr:
+            frames = soxr.resample(frames, sr, target_sr)
+        sf.write(str(output_path), _prepare(frames, spec), target_sr, format=spec["format"], subtype=spec["subtype"])
+    return output_path
+
+
+class StemWriter:
+    """
+    קידוד סטם בבלוקים (channels, samples) לפורמט המבוקש - זיכרון קבוע גם לשירים ארוכים
+    """
+
+    def __init__(self, output_path: Path, sr: int, channels: int, output_format: str):
+        self.spec = get_output_format(output_format)
+        target_sr = self.spec.get("samplerate", sr)
+        self._resampler = soxr.ResampleStream(sr, target_sr, channels, dtype="float32") if target_sr != sr else None
+        self._channels = channels
+        self._out = sf.SoundFile(str(output_path), "w", samplerate=target_sr, channels=channels,
+                                 format=self.spec["format"], subtype=self.spec["subtype"])
+
+    def write(self, block: np.ndarray, last: bool = False) -> None:
+        frames = np.ascontiguousarray(block.T, dtype=np.float32)
+        if self._resampler is not None:
+            frames = self._resampler.resample_chunk(frames, last=last)
+        if len(frames):
+            self._out.write(_prepare(frames, self.spec))
+
+    def close(self) -> None:
+        if self._resampler is not None:
+            self.write(np.zeros((self._channels, 0), dtype=np.float32), last=True)
+            self._resampler = None
+        self._out.close()
+
+    def __enter__(self) -> "StemWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def encode_stem_arrays(stems: Dict[str, np.ndarray], sr: int, output_dir: Path, output_format: str) -> Dict[str, Path]:
+    """
+    קידוד כל הסטמים במקביל ב-encode_pool
+    """
+    futures = {
+        stem_name: encode_pool.submit(write_stem, audio, sr, Path(output_dir) / stem_filename(stem_name, output_format), output_format)
+        for stem_name, audio in stems.items()
+    }
+    return {stem_name: future.result() for stem_name, future in futures.items()}
+
+
+def describe_stem_file(path: Path, output_format: str) -> Dict[str, Any]:
+    """
+    פורמט, media type וגודל של קובץ סטם - לפרסום בתשובה ללקוח
+    """
+    spec = get_output_format(output_format)
+    return {
+        "format": output_format,
+        "media_type": spec["media_type"],
+        "samplerate": sf.info(str(path)).samplerate,
+        "size_bytes": os.path.getsize(path)
+    }
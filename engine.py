@@ -0,0 +1,427 @@
+"""
+musicRay - מנוע הפרדה תושב (Resident Separator Engine)
+טוען את מודל Demucs פעם אחת ומריץ apply_model ישירות על טנזורים בזיכרון
+"""
+
+import math
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Deque, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from demucs.apply import TensorChunk, apply_model
+from demucs.pretrained import get_model
+from demucs.utils import center_trim
+
+# הגדרות מנוע
+DEVICE = os.getenv("MUSICRAY_DEVICE") or ("cuda" if torch.cuda.is_available() else "cpu")
+MODEL_NAME = os.getenv("DEMUCS_MODEL", "htdemucs")
+STEM_NAMES = ["vocals", "drums", "bass", "other"]
+
+# batching בין בקשות: עד BATCH_SIZE חלונות מכמה עבודות ב-forward pass אחד
+# 1 = ללא batching (כל עבודה מריצה את apply_model בעצמה)
+BATCH_SIZE = int(os.getenv("SEPARATION_BATCH_SIZE", "1"))
+BATCH_MAX_WAIT_MS = float(os.getenv("SEPARATION_BATCH_WAIT_MS", "15"))
+
+# דיוק ההסקה: fp32 / fp16 / bf16 (autocast) / int8 (dynamic quantization, CPU בלבד)
+PRECISION = os.getenv("MUSICRAY_PRECISION", "fp32").lower()
+PRECISIONS = ("fp32", "fp16", "bf16", "int8")
+
+# threads של torch ב-CPU (0 = ברירת המחדל של torch)
+NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "0"))
+INTEROP_THREADS = int(os.getenv("TORCH_INTEROP_THREADS", "0"))
+
+
+def configure_threads(num_threads: int = NUM_THREADS, interop_threads: int = INTEROP_THREADS) -> None:
+    """
+    הגדרת threads של torch - interop חייב להיקבע לפני עבודה מקבילית ראשונה
+    """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            print(f"אזהרה: לא ניתן לשנות interop threads: {str(e)}")
+
+
+configure_threads()
+
+
+@lru_cache(maxsize=None)
+def resolve_precision(precision: str, device: str) -> str:
+    """
+    הדיוק שבפועל נתמך על ה-device (fp16 ב-CPU -> bf16, int8 ב-GPU -> fp16)
+    נשמר לכל (precision, device) - משמש גם במפתח המטמון, והאזהרה מודפסת פעם אחת
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"דיוק לא נתמך: {precision}. נתמכים: {', '.join(PRECISIONS)}")
+    resolved = precision
+    if device.startswith("cuda"):
+        if precision == "int8":
+            resolved = "fp16"
+        elif precision == "bf16" and not torch.cuda.is_bf16_supported():
+            resolved = "fp16"
+    elif precision == "fp16":
+        resolved = "bf16"
+    if resolved != precision:
+        print(f"אזהרה: {precision} לא נתמך על {device}, משתמש ב-{resolved}")
+    return resolved
+
+
+class SeparatorEngine:
+    """
+    מודל Demucs שנטען פעם אחת ונשאר על ה-device לאורך חיי התהליך
+    """
+
+    def __init__(self, model_name: str = MODEL_NAME, device: str = DEVICE, precision: str = PRECISION):
+        start = time.time()
+        self.model_name = model_name
+        self.device = device
+        self.precision = resolve_precision(precision, device)
+
+        self.model = get_model(model_name)
+        self.model.to(device)
+        self.model.eval()
+
+        # int8 - שכבות Linear/LSTM עם משקלים כמותיים, חישוב activations דינמי
+        if self.precision == "int8":
+            torch.ao.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8, inplace=True
+            )
+        self.autocast_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(self.precision)
+
+        self.samplerate = self.model.samplerate
+        self.audio_channels = self.model.audio_channels
+        self.sources = list(self.model.sources)
+
+        # מודלי Transformer (htdemucs) לא תומכים בפלחים ארוכים מאורך האימון
+        self.max_segment = float(getattr(self.model, "max_allowed_segment", float("inf")))
+
+        # הסקה אחת בכל פעם על אותו device
+        self._lock = threading.Lock()
+
+        # מתזמן batching משותף (מוגדר ב-get_engine כש-BATCH_SIZE > 1)
+        self.batcher: Optional["SegmentBatcher"] = None
+
+        self.load_time = time.time() - start
+        print(f"🧠 מודל {model_name} נטען על {device} [{self.precision}] ({self.load_time:.1f}s)")
+
+    @contextmanager
+    def inference(self):
+        """
+        הקשר ההסקה: inference_mode (בלי מעקב autograd ו-version counters) ו-autocast לפי הדיוק
+        """
+        with torch.inference_mode():
+            if self.autocast_dtype is None:
+                yield
+            else:
+                with torch.autocast(device_type=torch.device(self.device).type, dtype=self.autocast_dtype):
+                    yield
+
+    def clamp_segment(self, segment: Optional[float]) -> Optional[float]:
+        """
+        הגבלת אורך הפלח למקסימום שהמודל תומך בו
+        """
+        if segment is None:
+            return None
+        return min(float(segment), self.max_segment)
+
+    def _prepare(self, audio: Union[np.ndarray, torch.Tensor]) -> torch.Tensor:
+        """
+        מערך (channels, samples) לטנזור float32 במספר הערוצים של המודל
+        """
+        wav = torch.as_tensor(audio, dtype=torch.float32)
+        if wav.dim() == 1:
+            wav = wav.unsqueeze(0)
+        if wav.shape[0] == 1 and self.audio_channels == 2:
+            wav = wav.expand(2, -1)
+        return wav[: self.audio_channels]
+
+    def _apply(
+        self,
+        wav: torch.Tensor,
+        ref_mean: torch.Tensor,
+        ref_std: torch.Tensor,
+        shifts: int,
+        overlap: float,
+        segment: Optional[float],
+    ) -> Dict[str, np.ndarray]:
+        """
+        הרצת המודל על קטע עם נורמליזציה נתונה (כמו ב-demucs.separate)
+        """
+        wav = (wav - ref_mean) / ref_std
+
+        if self.batcher is not None:
+            sources = self.batcher.separate(wav, shifts, overlap, self.clamp_segment(segment))
+        else:
+            with self._lock, self.inference():
+                sources = apply_model(
+                    self.model,
+                    wav[None],
+                    device=self.device,
+                    shifts=shifts,
+                    split=True,
+                    overlap=overlap,
+                    segment=self.clamp_segment(segment),
+                    progress=False,
+                )[0].float()
+
+        sources = sources * ref_std + ref_mean
+
+        stems = {}
+        for source_name, source in zip(self.sources, sources):
+            stems[source_name] = source.cpu().numpy().astype(np.float32, copy=False)
+
+        return {name: stems[name] for name in STEM_NAMES if name in stems}
+
+    @staticmethod
+    def _reference(wav: torch.Tensor):
+        ref = wav.mean(0)
+        return ref.mean(), ref.std().clamp_min(1e-8)
+
+    def separate(
+        self,
+        audio: Union[np.ndarray, torch.Tensor],
+        shifts: int = 1,
+        overlap: float = 0.25,
+        segment: Optional[float] = None,
+    ) -> Dict[str, np.ndarray]:
+        """
+        הפרדת מיקס (channels, samples) ב-samplerate של המודל לסטמים
+        מחזיר מילון stem -> מערך float32 בצורה (channels, samples)
+        """
+        wav = self._prepare(audio)
+        ref_mean, ref_std = self._reference(wav)
+        return self._apply(wav, ref_mean, ref_std, shifts, overlap, segment)
+
+    def iter_separate(
+        self,
+        audio: Union[np.ndarray, torch.Tensor],
+        shifts: int = 1,
+        overlap: float = 0.25,
+        segment: Optional[float] = None,
+        first_chunk_sec: float = 10.0,
+        chunk_sec: float = 30.0,
+        context_sec: float = 3.0,
+    ) -> Iterator[Tuple[int, int, Dict[str, np.ndarray]]]:
+        """
+        הפרדה הדרגתית - מחזיר (start, end, stems) לכל קטע לפי הסדר
+        כל קטע מופרד עם context_sec של הקשר משני הצדדים שנחתך אחר כך,
+        והנורמליזציה מחושבת פעם אחת על כל השיר - כך שהתפרים לא נשמעים
+        הקטע הראשון קצר כדי שהשניות הראשונות יהיו זמינות מהר
+        """
+        wav = self._prepare(audio)
+        ref_mean, ref_std = self._reference(wav)
+        total = wav.shape[-1]
+        context = int(context_sec * self.samplerate)
+
+        start = 0
+        length = int(first_chunk_sec * self.samplerate)
+        while start < total:
+            end = min(start + length, total)
+            # קטע אחרון קצר מדי מצורף לקטע הנוכחי
+            if total - end < context:
+                end = total
+            lo = max(start - context, 0)
+            hi = min(end + context, total)
+
+            stems = self._apply(wav[:, lo:hi], ref_mean, ref_std, shifts, overlap, segment)
+            yield start, end, {name: np.ascontiguousarray(stem[:, start - lo:end - lo]) for name, stem in stems.items()}
+
+            start = end
+            length = int(chunk_sec * self.samplerate)
+
+    def warmup(self, seconds: Optional[float] = None) -> float:
+        """
+        הרצת הסקה מדומה אחת כדי להקצות זיכרון ולטעון kernels לפני הבקשה הראשונה
+        מחזיר את זמן ה-warmup בשניות
+        """
+        start = time.time()
+        if seconds is None:
+            seconds = min(self.max_segment, 8.0)
+        
+        rng = np.random.default_rng(0)
+        dummy = 0.01 * rng.standard_normal((self.audio_channels, int(seconds * self.samplerate)), dtype=np.float32)
+        self.separate(dummy, shifts=1, overlap=0.25, segment=seconds)
+        
+        if self.device == "cuda":
+            torch.cuda.synchronize()
+        
+        elapsed = time.time() - start
+        print(f"🔥 warmup הושלם ({elapsed:.1f}s)")
+        return elapsed
+
+
+class SegmentBatcher:
+    """
+    מתזמן batching לפני המנוע: כל עבודה מחלקת את השיר לחלונות (shifts + overlap כמו ב-apply_model),
+    ו-thread יחיד אוסף חלונות מכמה עבודות במקביל ל-forward pass אחד ומחזיר לכל עבודה את התוצאות שלה
+    """
+
+    def __init__(self, engine: SeparatorEngine, batch_size: int = BATCH_SIZE, max_wait_ms: float = BATCH_MAX_WAIT_MS):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        # כל עבודה מחזיקה עד שני batches בתור - כך חלונות של עבודות שונות משתלבים
+        self.max_inflight = batch_size * 2
+
+        self._queue: "queue.Queue[Tuple[torch.Tensor, float, Future]]" = queue.Queue()
+        self._carry: List[Tuple[torch.Tensor, float, Future]] = []
+
+        self.batches = 0
+        self.windows = 0
+
+        self._thread = threading.Thread(target=self._loop, name="musicray-batcher", daemon=True)
+        self._thread.start()
+        print(f"📦 GPU batching: עד {batch_size} חלונות ל-batch, המתנה עד {max_wait_ms:.0f}ms")
+
+    def default_segment(self) -> float:
+        if math.isfinite(self.engine.max_segment):
+            return self.engine.max_segment
+        model = getattr(self.engine.model, "models", [self.engine.model])[0]
+        return float(getattr(model, "segment", 8.0))
+
+    def submit(self, window: torch.Tensor, segment: float) -> Future:
+        future: Future = Future()
+        self._queue.put((window, segment, future))
+        return future
+
+    def separate(self, wav: torch.Tensor, shifts: int, overlap: float, segment: Optional[float]) -> torch.Tensor:
+        """
+        הפרדת מיקס מנורמל (channels, samples) דרך ה-batcher - מחזיר (sources, channels, samples)
+        """
+        segment = segment or self.default_segment()
+        length = wav.shape[-1]
+        if not shifts:
+            return self._split(wav, overlap, segment)
+
+        # אותו מנגנון shifts כמו ב-apply_model - הזזה אקראית של עד חצי שנייה
+        max_shift = int(0.5 * self.engine.samplerate)
+        padded = torch.nn.functional.pad(wav, (max_shift, max_shift))
+        out = 0.0
+        for _ in range(shifts):
+            offset = random.randint(0, max_shift)
+            shifted_out = self._split(padded[:, offset:length + max_shift], overlap, segment)
+            out = out + shifted_out[..., max_shift - offset:]
+        return out / shifts
+
+    def _split(self, mix: torch.Tensor, overlap: float, segment: float) -> torch.Tensor:
+        """
+        חלונות חופפים עם משקל משולש ו-overlap-add (כמו split=True ב-apply_model)
+        """
+        channels, length = mix.shape
+        segment_length = int(self.engine.samplerate * segment)
+        stride = int((1 - overlap) * segment_length)
+
+        weight = torch.cat([
+            torch.arange(1, segment_length // 2 + 1),
+            torch.arange(segment_length - segment_length // 2, 0, -1),
+        ]).float()
+        weight = weight / weight.max()
+
+        out = torch.zeros(len(self.engine.sources), channels, length)
+        sum_weight = torch.zeros(length)
+        pending: Deque[Tuple[int, int, Future]] = deque()
+
+        def collect() -> None:
+            offset, chunk_length, future = pending.popleft()
+            chunk_out = center_trim(future.result(), chunk_length)
+            out[..., offset:offset + chunk_length] += weight[:chunk_length] * chunk_out
+            sum_weight[offset:offset + chunk_length] += weight[:chunk_length]
+
+        for offset in range(0, length, stride):
+            chunk = TensorChunk(mix[None], offset, segment_length)
+            window = chunk.padded(segment_length)[0]
+            pending.append((offset, chunk.length, self.submit(window, segment)))
+            if len(pending) >= self.max_inflight:
+                collect()
+        while pending:
+            collect()
+
+        return out / sum_weight
+
+    def _collect_batch(self) -> List[Tuple[torch.Tensor, float, Future]]:
+        """
+        החלון הראשון שממתין, ועוד חלונות באותה צורה עד batch_size או עד תום זמן ההמתנה
+        """
+        first = self._carry.pop(0) if self._carry else self._queue.get()
+        batch = [first]
+        key = (first[0].shape, first[1])
+
+        for item in list(self._carry):
+            if len(batch) >= self.batch_size:
+                break
+            if (item[0].shape, item[1]) == key:
+                self._carry.remove(item)
+                batch.append(item)
+
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if (item[0].shape, item[1]) == key:
+                batch.append(item)
+            else:
+                self._carry.append(item)
+        return batch
+
+    def _loop(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            try:
+                mix = torch.stack([window for window, _, _ in batch])
+                with self.engine._lock, self.engine.inference():
+                    out = apply_model(
+                        self.engine.model,
+                        mix,
+                        device=self.engine.device,
+                        shifts=0,
+                        split=False,
+                        segment=batch[0][1],
+                        progress=False,
+                    ).float().cpu()
+                self.batches += 1
+                self.windows += len(batch)
+                for (_, _, future), window_out in zip(batch, out):
+                    future.set_result(window_out)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "batches": self.batches,
+            "windows": self.windows,
+            "avg_batch_size": round(self.windows / self.batches, 2) if self.batches else 0.0,
+        }
+
+
+_engine: Optional[SeparatorEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> SeparatorEngine:
+    """
+    החזרת מנוע ההפרדה המשותף (נטען בקריאה הראשונה)
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = SeparatorEngine()
+                if BATCH_SIZE > 1:
+                    engine.batcher = SegmentBatcher(engine)
+                _engine = engine
+    return _engine
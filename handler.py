@@ -3,35 +3,77 @@ musicRay - RunPod Serverless Handler
 מעבד קבצי שמע והופך אותם ל-4 סטמים באמצעות Demucs
 """
 
+import time
+_PROCESS_START = time.time()
+
 import os
 import json
 import tempfile
-import subprocess
-import shutil
 from pathlib import Path
+from typing import Optional
 import requests
-import torch
-import librosa
-import soundfile as sf
 import numpy as np
 from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import runpod
 
-# הגדרת device
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+from analysis import analyze_array
+from cache import ResultCache, hash_file, make_cache_key
+from encode import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, encode_stem_arrays, media_type_for, stem_filename
+from engine import DEVICE, get_engine
+from metrics import CACHE_LOOKUPS, Trace
+from quality import AUTO, COST_MODEL, candidate_profiles, choose_profile, get_profile_params, profile_choice, validate_quality
+from separate import decode_audio
+from sinks import UPLOAD_WORKERS, create_sink
+
+# device של המנוע (MUSICRAY_DEVICE או זיהוי אוטומטי)
 print(f"🎵 musicRay Serverless Handler - Device: {DEVICE}")
 
+# טעינת המודל פעם אחת ברמת המודול - נשאר בזיכרון בין אירועים
+ENGINE = get_engine()
+
+# זמני cold start של ה-worker - מדווחים בכל תשובה
+READINESS = {"model_load_sec": round(ENGINE.load_time, 2)}
+
+# מטמון תוצאות - על ה-network volume אם קיים, כך שהוא משותף בין workers
+if os.path.isdir("/runpod-volume"):
+    CACHE_DIR = os.getenv("CACHE_DIR", "/runpod-volume/musicray-cache")
+else:
+    CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(tempfile.gettempdir(), "musicray-cache"))
+RESULT_CACHE = ResultCache(Path(CACHE_DIR))
+
+STEM_NAMES = ["vocals", "drums", "bass", "other"]
+SEPARATION_SR = 44100
+
+# session HTTP משותף עם connection pool - נשמר בין אירועים
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(pool_maxsize=UPLOAD_WORKERS, max_retries=Retry(total=3, backoff_factor=0.5)))
+HTTP_SESSION.mount("http://", HTTPAdapter(pool_maxsize=UPLOAD_WORKERS, max_retries=Retry(total=3, backoff_factor=0.5)))
+
+# יעד התוצאות (S3 / מקומי) - client ו-pool יחידים לכל ה-worker
+RESULT_SINK = create_sink()
+
+def warmup() -> dict:
+    """
+    חימום ה-worker לפני קבלת אירועים: הסקה מדומה שמקצה זיכרון GPU וטוענת kernels
+    """
+    READINESS["warmup_sec"] = round(ENGINE.warmup(), 2)
+    READINESS["ready_sec"] = round(time.time() - _PROCESS_START, 2)
+    print(f"✅ Worker מוכן אחרי {READINESS['ready_sec']}s (טעינת מודל {READINESS['model_load_sec']}s, warmup {READINESS['warmup_sec']}s)")
+    return READINESS
+
 def download_file(url: str, output_path: str) -> bool:
     """
     הורדת קובץ מURL
     """
     try:
         print(f"📥 מוריד קובץ מ: {url}")
-        response = requests.get(url, stream=True, timeout=300)
+        response = HTTP_SESSION.get(url, stream=True, timeout=300)
         response.raise_for_status()
         
         with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
                 if chunk:
                     f.write(chunk)
         
@@ -43,34 +85,10 @@ def download_file(url: str, output_path: str) -> bool:
         print(f"❌ שגיאה בהורדה: {str(e)}")
         return False
 
-def convert_to_wav(input_path: str, output_path: str) -> bool:
-    """
-    המרה ל-WAV 44.1kHz stereo
-    """
-    try:
-        print(f"🔄 ממיר ל-WAV: {input_path}")
-        
-        # קריאת הקובץ עם librosa
-        audio, sr = librosa.load(input_path, sr=44100, mono=False)
-        
-        # וידוא stereo
-        if audio.ndim == 1:
-            audio = np.stack([audio, audio])
-        elif audio.shape[0] > 2:
-            audio = audio[:2]
-        
-        # שמירה
-        sf.write(output_path, audio.T, 44100, subtype='FLOAT')
-        print(f"✅ המרה הושלמה: {output_path}")
-        return True
-        
-    except Exception as e:
-        print(f"❌ שגיאה בהמרה: {str(e)}")
-        return False
-
-def separate_audio(input_path: str, output_dir: str) -> dict:
+def separate_audio(audio: np.ndarray, output_dir: str, output_format: str = DEFAULT_OUTPUT_FORMAT, params: dict = None) -> dict:
     """
-    הפרדת שמע ל-4 סטמים באמצעות Demucs
+    הפרדת מערך מפוענח (2, samples) ל-4 סטמים באמצעות Demucs (מנוע תושב) וקידוד לפורמט הפלט
+    הסטמים עוברים מהזיכרון ישירות לקידוד - רק קבצי הפלט נכתבים לדיסק
     """
     try:
         print(f"🎯 מפריד שמע עם Demucs על {DEVICE}")
@@ -78,102 +96,46 @@ def separate_audio(input_path: str, output_dir: str) -> dict:
         # יצירת תיקיית פלט
         os.makedirs(output_dir, exist_ok=True)
         
-        # פקודת Demucs מותאמת לServerless
-        cmd = [
-            "python", "-m", "demucs.separate",
-            "--name", "htdemucs",
-            "--device", DEVICE,
-            "--shifts", "5" if DEVICE == "cuda" else "1",
-            "--overlap", "0.25",
-            "--segment", "8" if DEVICE == "cuda" else "4",
-            "--out", output_dir,
-            input_path
-        ]
+        # פרמטרי פרופיל האיכות (ברירת מחדל לפי ה-device)
+        params = params or get_profile_params()
+        print(f"📝 פרמטרים: {params}")
         
-        print(f"📝 מריץ: {' '.join(cmd[-6:])}")
-        
-        # הרצת Demucs
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=1800  # 30 דקות timeout
+        # הרצת המודל הטעון על המערך שבזיכרון
+        stems = ENGINE.separate(
+            audio,
+            shifts=params["shifts"],
+            overlap=params["overlap"],
+            segment=params["segment"],
         )
         
-        if result.returncode != 0:
-            raise Exception(f"Demucs נכשל: {result.stderr}")
-        
         print("✅ Demucs הושלם בהצלחה")
         
-        # מציאת קבצי הפלט
-        input_name = Path(input_path).stem
-        stems_dir = Path(output_dir) / "htdemucs" / input_name
-        
-        if not stems_dir.exists():
-            raise Exception(f"תיקיית פלט לא נמצאה: {stems_dir}")
-        
-        # העברת הקבצים לתיקייה הראשית
+        # קידוד הסטמים במקביל ב-encode pool
         stem_files = {}
-        for stem_name in ["vocals", "drums", "bass", "other"]:
-            src_file = stems_dir / f"{stem_name}.wav"
-            dst_file = Path(output_dir) / f"{stem_name}.wav"
-            
-            if src_file.exists():
-                shutil.move(str(src_file), str(dst_file))
-                stem_files[stem_name] = str(dst_file)
-                print(f"✅ {stem_name}: {dst_file}")
-            else:
-                print(f"⚠️  חסר: {stem_name}")
-        
-        # ניקוי תיקיית Demucs הזמנית
-        shutil.rmtree(Path(output_dir) / "htdemucs", ignore_errors=True)
+        for stem_name, dst_file in encode_stem_arrays(stems, ENGINE.samplerate, Path(output_dir), output_format).items():
+            stem_files[stem_name] = str(dst_file)
+            print(f"✅ {stem_name}: {dst_file}")
         
         return stem_files
         
-    except subprocess.TimeoutExpired:
-        raise Exception("Demucs חרג מזמן הריצה המותר (30 דקות)")
     except Exception as e:
         print(f"❌ שגיאה בהפרדת השמע: {str(e)}")
         raise
 
-def analyze_audio(audio_path: str) -> dict:
+def analyze_audio(audio: np.ndarray, sr: int = SEPARATION_SR) -> Optional[dict]:
     """
-    ניתוח שמע - BPM ו-Key
+    ניתוח שמע - BPM ו-Key (כולל עקומה לכל חלון) על המערך המפוענח
+    None אם הניתוח נכשל (לא מחזירים ערכי ברירת מחדל - הם היו נשמרים במטמון כתוצאה אמיתית)
     """
     try:
         print("📊 מנתח שמע...")
         
-        # טעינת השמע
-        y, sr = librosa.load(audio_path, sr=22050)
-        duration = librosa.get_duration(y=y, sr=sr)
-        
-        # חישוב BPM
-        tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
-        if tempo < 60:
-            tempo *= 2
-        elif tempo > 200:
-            tempo /= 2
-        
-        # זיהוי מפתח (פשוט)
-        chroma = librosa.feature.chroma_stft(y=y, sr=sr)
-        chroma_mean = np.mean(chroma, axis=1)
-        note_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-        dominant_note = note_names[np.argmax(chroma_mean)]
-        
-        # זיהוי מודוס פשוט
-        major_profile = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
-        minor_profile = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
-        
-        major_corr = np.corrcoef(chroma_mean, major_profile / np.sum(major_profile))[0, 1]
-        minor_corr = np.corrcoef(chroma_mean, minor_profile / np.sum(minor_profile))[0, 1]
-        
-        mode = "major" if major_corr > minor_corr else "minor"
-        key = f"{dominant_note} {mode}"
-        
+        analysis = analyze_array(audio, sr)
         result = {
-            "bpm": int(tempo),
-            "key": key,
-            "duration_sec": round(duration, 1)
+            "bpm": int(analysis["bpm"]),
+            "key": analysis["key"],
+            "duration_sec": round(analysis["duration_sec"], 1),
+            "timeline": analysis["timeline"]
         }
         
         print(f"✅ ניתוח: BPM={result['bpm']}, Key={result['key']}, Duration={result['duration_sec']}s")
@@ -181,7 +143,7 @@ def analyze_audio(audio_path: str) -> dict:
         
     except Exception as e:
         print(f"⚠️  שגיאה בניתוח: {str(e)}")
-        return {"bpm": 120, "key": "C major", "duration_sec": 180.0}
+        return None
 
 def handler(event):
     """
@@ -194,60 +156,123 @@ def handler(event):
         # בדיקת input
         input_data = event.get("input", {})
         file_url = input_data.get("file_url")
+        output_format = str(input_data.get("output_format", DEFAULT_OUTPUT_FORMAT)).lower()
+        quality = str(input_data.get("quality", AUTO)).lower()
         
         if not file_url:
             return {
                 "error": "חסר שדה file_url ב-input"
             }
         
+        if output_format not in OUTPUT_FORMATS:
+            return {
+                "error": f"פורמט פלט לא נתמך: {output_format}. נתמכים: {', '.join(OUTPUT_FORMATS)}"
+            }
+        
+        try:
+            quality = validate_quality(quality)
+        except ValueError as e:
+            return {"error": str(e)}
+        
+        # spans לכל שלב - מוחזרים ב-processing_info
+        trace = Trace()
+        
         # יצירת תיקיות זמניות
         with tempfile.TemporaryDirectory() as temp_dir:
             temp_path = Path(temp_dir)
             
             # נתיבי קבצים
             original_file = temp_path / "input_audio"
-            wav_file = temp_path / "input.wav"
             stems_dir = temp_path / "stems"
             stems_dir.mkdir()
             
             # הורדת הקובץ
-            if not download_file(file_url, str(original_file)):
+            with trace.span("download"):
+                downloaded = download_file(file_url, str(original_file))
+            if not downloaded:
                 return {"error": "שגיאה בהורדת הקובץ"}
             
-            # המרה ל-WAV
-            if not convert_to_wav(str(original_file), str(wav_file)):
-                return {"error": "שגיאה בהמרת הקובץ ל-WAV"}
-            
-            # הפרדת סטמים
-            stem_files = separate_audio(str(wav_file), str(stems_dir))
+            # בדיקת מטמון לפי תוכן הקובץ ופרמטרי ההפרדה - ב-auto כל פרופיל מותר, מהאיכותי ביותר
+            with trace.span("cache_lookup"):
+                content_hash = hash_file(original_file)
+                
+                def cache_key_for(profile: str) -> str:
+                    return make_cache_key(content_hash, {**get_profile_params(profile), "format": output_format})
+                
+                entry = None
+                for profile in candidate_profiles(quality):
+                    cache_key = cache_key_for(profile)
+                    entry = RESULT_CACHE.lookup(cache_key)
+                    if entry is not None:
+                        quality_info = profile_choice(quality, profile)
+                        break
+            cached = entry is not None
+            CACHE_LOOKUPS.inc(result="hit" if cached else "miss")
             
-            if not stem_files:
-                return {"error": "שגיאה בהפרדת הסטמים"}
-            
-            # ניתוח השמע
-            analysis = analyze_audio(str(wav_file))
+            if not cached:
+                # פענוח לזיכרון - 44.1kHz stereo, בלי קובץ WAV ביניים
+                try:
+                    with trace.span("decode"):
+                        audio = decode_audio(original_file, SEPARATION_SR)
+                except Exception as e:
+                    print(f"❌ שגיאה בפענוח: {str(e)}")
+                    return {"error": "שגיאה בפענוח קובץ השמע"}
+                
+                # בחירת פרופיל לפי אורך השיר (worker מעבד אירוע אחד בכל פעם)
+                duration = audio.shape[1] / SEPARATION_SR
+                quality_info = choose_profile(quality, duration)
+                params = get_profile_params(quality_info["profile"])
+                cache_key = cache_key_for(quality_info["profile"])
+                uploads = RESULT_SINK.start(cache_key)
+                
+                # הפרדת סטמים
+                separate_start = time.time()
+                with trace.span("separate", profile=quality_info["profile"], format=output_format):
+                    stem_files = separate_audio(audio, str(stems_dir), output_format, params)
+                COST_MODEL.observe(duration, params["shifts"], time.time() - separate_start)
+                
+                if not stem_files:
+                    return {"error": "שגיאה בהפרדת הסטמים"}
+                
+                # העלאת הסטמים ברקע בזמן שהניתוח רץ
+                for stem_name, file_path in stem_files.items():
+                    uploads.upload(stem_name, Path(file_path), media_type_for(file_path))
+                
+                # ניתוח השמע
+                with trace.span("analyze"):
+                    analysis = analyze_audio(audio)
+                del audio
+                
+                if analysis is None:
+                    return {"error": "שגיאה בניתוח השמע"}
+                
+                with trace.span("cache_store"):
+                    RESULT_CACHE.store(cache_key, stems_dir, [Path(path).name for path in stem_files.values()], analysis)
+            else:
+                print(f"⚡ נמצא במטמון: {cache_key[:12]}")
+                analysis = entry["result"]
+                uploads = RESULT_SINK.start(cache_key)
+                for stem_name in STEM_NAMES:
+                    filename = stem_filename(stem_name, output_format)
+                    uploads.upload(stem_name, Path(entry["dir"]) / filename, media_type_for(filename))
             
-            # קריאת קבצי הסטמים ל-base64 (עבור החזרה)
-            stems_data = {}
-            for stem_name, file_path in stem_files.items():
-                if os.path.exists(file_path):
-                    # במקום base64, נחזיר רק מידע על הקובץ
-                    # ב-production אמיתי תעלה ל-S3 ותחזיר URLs
-                    file_size = os.path.getsize(file_path)
-                    stems_data[stem_name] = {
-                        "path": file_path,
-                        "size_mb": round(file_size / 1024 / 1024, 2),
-                        "exists": True
-                    }
+            # המתנה לסיום ההעלאות - URLs חתומים (S3) או נתיבים מקומיים
+            with trace.span("upload_wait"):
+                stems_data = uploads.results()
             
             # תשובה מוצלחת
             result = {
                 "success": True,
                 "stems": stems_data,
+                "output_format": output_format,
+                "quality": quality_info,
                 "analysis": analysis,
                 "processing_info": {
                     "device": DEVICE,
                     "total_stems": len(stems_data),
+                    "cached": cached,
+                    "readiness": READINESS,
+                    "trace": trace.to_dict(),
                     "message": "עיבוד הושלם בהצלחה"
                 }
             }
@@ -269,4 +294,5 @@ def handler(event):
 # רישום ל-RunPod Serverless
 if __name__ == "__main__":
     print("🏃 מתחיל RunPod Serverless Handler...")
+    warmup()
     runpod.serverless.start({"handler": handler})
@@ -0,0 +1,180 @@
+"""
+musicRay - תור עבודות אסינכרוני
+מריץ את צינור העיבוד ב-worker pool מוגבל מחוץ ל-event loop
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import JOB_QUEUE_WAIT_SECONDS, JOBS_TOTAL, Trace
+
+# גודל ה-pool ואורך התור המקסימלי
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "1"))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "20"))
+
+# כמה זמן נשמר מצב של עבודה שהסתיימה (הקבצים עצמם מנוהלים ב-storage)
+JOB_RETENTION_SEC = float(os.getenv("JOB_RETENTION_SEC", str(24 * 3600)))
+
+
+class QueueFullError(Exception):
+    """
+    התור מלא - אין מקום לעבודה נוספת
+    """
+
+
+class JobFailedError(Exception):
+    """
+    שגיאה בעבודה שמכילה קוד סטטוס HTTP להחזרה ללקוח
+    """
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class Job:
+    """
+    מצב עבודה בודדת בתור
+    """
+
+    def __init__(self, job_id: str, filename: str):
+        self.job_id = job_id
+        self.filename = filename
+        self.status = "queued"  # queued / running / done / failed
+        self.stage = "queued"
+        self.progress = 0.0
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.error_status: Optional[int] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.trace = Trace()  # spans של שלבי העיבוד - /jobs/{job_id}/trace
+
+    def update(self, stage: str, progress: float) -> None:
+        """
+        עדכון שלב והתקדמות (נקרא מתוך ה-worker)
+        """
+        self.stage = stage
+        self.progress = round(min(max(progress, 0.0), 1.0), 3)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "filename": self.filename,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """
+    תור עבודות עם worker pool מוגבל
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, max_queue_size: int = MAX_QUEUE_SIZE, retention_sec: float = JOB_RETENTION_SEC):
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.retention_sec = retention_sec
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="musicray-job")
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self.service_sec: Optional[float] = None  # ממוצע נע (EWMA) של זמן עיבוד עבודה שהצליחה
+
+    def submit(self, job_id: str, filename: str, fn: Callable[[Job], Dict[str, Any]]) -> Job:
+        """
+        הוספת עבודה לתור - fn מקבלת את אובייקט ה-Job ומחזירה את התוצאה
+        """
+        with self._lock:
+            self._prune()
+            if sum(1 for job in self._jobs.values() if job.status == "queued") >= self.max_queue_size:
+                raise QueueFullError("התור מלא, נסה שוב מאוחר יותר")
+            job = Job(job_id, filename)
+            self._jobs[job_id] = job
+
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def forget(self, job_id: str) -> None:
+        """
+        הסרת עבודה שהסתיימה (הקבצים שלה נמחקו) - עבודות פעילות נשארות
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.finished_at is not None:
+                del self._jobs[job_id]
+
+    def _prune(self) -> None:
+        """
+        הסרת עבודות שהסתיימו לפני יותר מ-retention_sec (נקרא תחת הנעילה)
+        """
+        cutoff = time.time() - self.retention_sec
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished_at is not None and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def _snapshot(self) -> List[Job]:
+        """
+        העבודות הנוכחיות - עותק תחת הנעילה (submit ו-forget משנים את המילון מ-threads אחרים)
+        """
+        with self._lock:
+            return list(self._jobs.values())
+
+    def queued_count(self) -> int:
+        return sum(1 for job in self._snapshot() if job.status == "queued")
+
+    def running_count(self) -> int:
+        return sum(1 for job in self._snapshot() if job.status == "running")
+
+    def estimated_wait(self, default_service_sec: float) -> float:
+        """
+        הערכת זמן ההמתנה של עבודה חדשה עד שתתחיל: מה שנשאר לעבודות שרצות ועבודות התור, מחולק ב-workers
+        default_service_sec - זמן עבודה משוער כשעוד לא נמדדו עבודות
+        """
+        service = self.service_sec if self.service_sec is not None else default_service_sec
+        jobs = self._snapshot()
+        running = [job for job in jobs if job.status == "running"]
+        queued = sum(1 for job in jobs if job.status == "queued")
+        if len(running) + queued < self.max_workers:
+            return 0.0
+        remaining = sum(service * (1.0 - job.progress) for job in running)
+        return round((remaining + queued * service) / self.max_workers, 1)
+
+    def _run(self, job: Job, fn: Callable[[Job], Dict[str, Any]]) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        JOB_QUEUE_WAIT_SECONDS.observe(job.started_at - job.created_at)
+        try:
+            job.result = fn(job)
+            job.status = "done"
+            job.update("done", 1.0)
+            # עבודות מהמטמון כמעט מיידיות - לא נכנסות להערכת זמן העיבוד
+            if not job.result.get("cached"):
+                elapsed = time.time() - job.started_at
+                self.service_sec = elapsed if self.service_sec is None else 0.7 * self.service_sec + 0.3 * elapsed
+        except JobFailedError as e:
+            job.status = "failed"
+            job.error = e.detail
+            job.error_status = e.status_code
+        except Exception as e:
+            print(f"שגיאה בעבודה {job.job_id}: {str(e)}")
+            job.status = "failed"
+            job.error = f"שגיאה בעיבוד השיר: {str(e)}"
+            job.error_status = 500
+        finally:
+            job.finished_at = time.time()
+            JOBS_TOTAL.inc(status=job.status)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,271 @@
+"""
+musicRay - מדדים בסגנון Prometheus ו-tracing לכל job
+Counter / Gauge / Histogram עם labels ופלט בפורמט הטקסט של Prometheus (בלי תלות חיצונית),
+ו-Trace שאוסף spans לכל שלב בעבודה וגם מעדכן את היסטוגרמת זמני השלבים
+"""
+
+import os
+import platform
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# גבולות ברירת מחדל (שניות) - מקטעים קצרים ועד שירים ארוכים על CPU
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Registry:
+    """
+    כל המדדים של התהליך - render() מחזיר את פלט /metrics
+    """
+
+    def __init__(self):
+        self._metrics: List["Metric"] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: "Metric") -> None:
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                label_str = ",".join(f'{key}="{_escape(str(val))}"' for key, val in labels)
+                lines.append(f"{name}{{{label_str}}} {_format_value(value)}" if label_str else f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Labels, Any] = {}
+        registry.register(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Labels:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: labels צפויים {self.labelnames}, התקבלו {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Labels) -> List[Tuple[str, str]]:
+        return list(zip(self.labelnames, key))
+
+    def samples(self) -> Iterator[Tuple[str, List[Tuple[str, str]], float]]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, self._labels(key), value
+
+
+class Counter(Metric):
+    """
+    ערך מצטבר שרק עולה
+    """
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    """
+    ערך נוכחי - נקבע ב-set או מחושב בכל קריאה ל-/metrics מ-fn (ללא labels)
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 fn: Optional[Callable[[], Optional[float]]] = None, registry: Registry = REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.fn = fn
+
+    def set(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self) -> Iterator[Tuple[str, List[Tuple[str, str]], float]]:
+        if self.fn is None:
+            yield from super().samples()
+            return
+        try:
+            value = self.fn()
+        except Exception:
+            value = None
+        if value is not None:
+            yield self.name, [], value
+
+
+class Histogram(Metric):
+    """
+    התפלגות (buckets מצטברים, sum, count) - זמני שלבים ובקשות
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry: Registry = REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> Iterator[Tuple[str, List[Tuple[str, str]], float]]:
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        for key, (counts, total, count) in items:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", labels + [("le", _format_value(bound))], cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+# מדדי הצינור - משותפים לשרת, ל-worker ול-handler
+STAGE_SECONDS = Histogram("musicray_stage_duration_seconds", "Duration of pipeline stages", ["stage"])
+JOBS_TOTAL = Counter("musicray_jobs_total", "Finished jobs by final status", ["status"])
+JOB_QUEUE_WAIT_SECONDS = Histogram("musicray_job_queue_wait_seconds", "Time jobs spent queued before a worker picked them up")
+CACHE_LOOKUPS = Counter("musicray_cache_lookups_total", "Result cache lookups", ["result"])
+UPLOAD_BYTES = Counter("musicray_upload_bytes_total", "Bytes received in uploads")
+STEM_BYTES = Counter("musicray_stem_output_bytes_total", "Bytes of encoded stems written", ["format"])
+SERVED_BYTES = Counter("musicray_served_bytes_total", "Bytes sent to clients", ["route"])
+HTTP_REQUESTS = Counter("musicray_http_requests_total", "HTTP requests", ["method", "route", "status"])
+HTTP_SECONDS = Histogram("musicray_http_request_duration_seconds", "HTTP request latency until response headers", ["route"])
+
+
+def read_rss_bytes() -> int:
+    """
+    RSS נוכחי של התהליך (Linux: /proc/self/statm, אחרת שיא ru_maxrss)
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if platform.system() == "Darwin" else maxrss * 1024
+
+
+class CpuSampler:
+    """
+    ניצול CPU של התהליך (אחוז מכל הליבות) מאז הדגימה הקודמת
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = (time.monotonic(), time.process_time())
+
+    def percent(self) -> float:
+        with self._lock:
+            now = (time.monotonic(), time.process_time())
+            wall, cpu = now[0] - self._last[0], now[1] - self._last[1]
+            self._last = now
+        if wall <= 0:
+            return 0.0
+        return round(100.0 * cpu / wall / (os.cpu_count() or 1), 1)
+
+
+PROCESS_RSS = Gauge("musicray_process_rss_bytes", "Resident memory of the server process", fn=read_rss_bytes)
+
+
+class Trace:
+    """
+    spans של עבודה אחת (שלב, התחלה יחסית, משך, מאפיינים) - לבדיקת הפירוק של job איטי
+    כל span גם נרשם ב-STAGE_SECONDS לפי שם השלב
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+        """
+        מדידת שלב - ה-dict שמוחזר מאפשר להוסיף מאפיינים תוך כדי (למשל גודל או פרופיל)
+        """
+        start = time.time()
+        t0 = time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - t0
+            STAGE_SECONDS.observe(duration, stage=name)
+            span = {
+                "name": name,
+                "start_sec": round(start - self.started_at, 4),
+                "duration_sec": round(duration, 4),
+                "thread": threading.current_thread().name,
+                **attrs,
+            }
+            if error is not None:
+                span["error"] = error
+            with self._lock:
+                self._spans.append(span)
+
+    def call(self, name: str, fn: Callable[..., Any], *args: Any) -> Any:
+        """
+        הרצת fn בתוך span (ל-submit של שלבים שרצים ב-pool אחר)
+        """
+        with self.span(name):
+            return fn(*args)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = sorted(self._spans, key=lambda span: span["start_sec"])
+        end = max((span["start_sec"] + span["duration_sec"] for span in spans), default=0.0)
+        return {"started_at": self.started_at, "total_sec": round(end, 4), "spans": spans}
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """
+    מדידת שלב ל-STAGE_SECONDS בלי trace (קוד משותף שלא מכיר את ה-job, למשל קידוד)
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage=stage)
@@ -0,0 +1,267 @@
+"""
+musicRay - צינור העיבוד המלא של עבודה
+הפרדה -> post-processing -> ניתוח, רץ בתוך worker של תור העבודות
+"""
+
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+import librosa
+import numpy as np
+
+from cache import ResultCache, make_cache_key
+from jobs import MAX_WORKERS, Job, JobFailedError
+from separate import decode_audio, get_progressive_params, get_separation_params, separate_array, separate_progressive
+from postprocess import postprocess_stem_arrays
+from encode import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, describe_stem_file, stem_filename
+from analysis import analyze_array
+from preview import preview_files
+from progressive import DONE_MARKER, STREAM_DIR, StemStreamWriter, release_stream
+from quality import AUTO, COST_MODEL, candidate_profiles, choose_profile, profile_choice
+from metrics import CACHE_LOOKUPS, STEM_BYTES
+
+SEPARATION_SR = 44100
+
+# מטא-דאטה של job שהושלם - מפתח התוכן משמש ל-ETag של קבצי הסטמים
+JOB_META_FILE = "job.json"
+
+# pool של CPU לניתוח BPM/Key שרץ במקביל להפרדה על ה-GPU
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "2"))
+analysis_pool = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix="musicray-analysis")
+
+STEM_NAMES = ["vocals", "drums", "bass", "other"]
+
+
+def stem_files(output_format: str = DEFAULT_OUTPUT_FORMAT) -> Dict[str, str]:
+    """
+    שמות קבצי הסטמים בפורמט הפלט
+    """
+    return {name: stem_filename(name, output_format) for name in STEM_NAMES}
+
+
+class PipelineContext:
+    """
+    פענוח יחיד של קובץ הקלט - מערך float32 משותף לכל שלבי העבודה
+    """
+
+    def __init__(self, input_path: Path, sr: int = SEPARATION_SR):
+        self.input_path = input_path
+        self.sr = sr
+        self.audio = decode_audio(input_path, sr)  # (2, samples) float32
+
+    @property
+    def duration(self) -> float:
+        return self.audio.shape[1] / self.sr
+
+
+def build_response(
+    job_id: str,
+    job_dir: Path,
+    analysis: Dict[str, Any],
+    cached: bool,
+    output_format: str = DEFAULT_OUTPUT_FORMAT,
+    quality: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    הכנת התשובה ללקוח מתוצאת הניתוח, כולל פורמט וגודל של כל סטם
+    """
+    files = stem_files(output_format)
+    return {
+        "job_id": job_id,
+        "stems": {name: f"/files/{job_id}/{filename}" for name, filename in files.items()},
+        "stem_files": {name: describe_stem_file(job_dir / filename, output_format) for name, filename in files.items()},
+        "output_format": output_format,
+        "available_formats": list(OUTPUT_FORMATS),
+        "bpm": analysis["bpm"],
+        "key": analysis["key"],
+        "duration_sec": analysis["duration_sec"],
+        "timeline": analysis.get("timeline", []),
+        "quality": quality,
+        "cached": cached
+    }
+
+
+def write_job_meta(job_dir: Path, cache_key: str, output_format: str) -> None:
+    """
+    שמירת מפתח התוכן והפורמט של ה-job (קבצי ה-job לא משתנים אחרי הכתיבה)
+    """
+    with open(job_dir / JOB_META_FILE, "w", encoding="utf-8") as f:
+        json.dump({"cache_key": cache_key, "output_format": output_format}, f)
+
+
+def read_job_meta(job_dir: Path) -> Optional[Dict[str, Any]]:
+    try:
+        with open(job_dir / JOB_META_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def check_duration(duration: float, max_duration: float) -> None:
+    """
+    דחיית שירים ארוכים מהמותר
+    """
+    if duration > max_duration:
+        raise JobFailedError(413, f"השיר ארוך מדי ({duration/60:.1f} דקות). מקסימום {max_duration // 60:.0f} דקות")
+
+
+def probe_duration(input_path: Path) -> Optional[float]:
+    """
+    משך הקובץ מתוך ה-header בלבד, בלי לפענח את השמע
+    """
+    try:
+        return float(librosa.get_duration(path=str(input_path)))
+    except Exception as e:
+        print(f"אזהרה: לא ניתן לקרוא משך מה-header: {str(e)}")
+        return None
+
+
+def run_analysis(ctx: PipelineContext) -> Dict[str, Any]:
+    """
+    ניתוח BPM ו-Key הדרגתי על האות המשותף (רץ ב-analysis_pool)
+    כולל עקומת tempo/key לכל חלון לזיהוי שינויי מפתח
+    """
+    result = analyze_array(ctx.audio, ctx.sr)
+    print(f"ניתוח הושלם: BPM={result['bpm']:.1f}, Key={result['key']}, {len(result['timeline'])} חלונות")
+    return {
+        "bpm": int(result["bpm"]),
+        "key": result["key"],
+        "duration_sec": round(result["duration_sec"], 1),
+        "timeline": result["timeline"]
+    }
+
+
+def separate_to_stream(job: Job, ctx: PipelineContext, stream_dir: Path, params: Dict[str, Any]) -> Dict[str, np.ndarray]:
+    """
+    הפרדה הדרגתית עם כתיבת כל קטע לזרם הסטמים ועדכון ההתקדמות
+    """
+    writer = StemStreamWriter(stream_dir)
+    total = ctx.audio.shape[1]
+    
+    def on_chunk(start: int, end: int, chunk: Dict[str, np.ndarray]) -> None:
+        writer.write(chunk)
+        job.update("separating", 0.05 + 0.65 * end / total)
+    
+    try:
+        return separate_progressive(ctx.audio, on_chunk, params)
+    finally:
+        writer.close()
+
+
+def run_pipeline(
+    job: Job,
+    input_path: Path,
+    job_dir: Path,
+    max_duration: float,
+    content_hash: str,
+    cache: Optional[ResultCache] = None,
+    output_format: str = DEFAULT_OUTPUT_FORMAT,
+    progressive: bool = False,
+    quality: str = AUTO,
+    queue_depth: Optional[Callable[[], int]] = None,
+) -> Dict[str, Any]:
+    """
+    הרצת כל שלבי העיבוד עבור קובץ שהועלה והחזרת התשובה ללקוח
+    progressive - כל קטע מופרד נכתב מיד לזרם של /jobs/{job_id}/stream/{stem}
+    quality - פרופיל איכות (fast/balanced/best) או auto לפי אורך השיר ועומק התור (queue_depth)
+    כל שלב נמדד כ-span ב-job.trace
+    """
+    job_id = job.job_id
+    trace = job.trace
+    try:
+        print(f"מתחיל עיבוד job {job_id} עבור קובץ {job.filename}")
+
+        def cache_key_for(profile: str) -> str:
+            params = {**get_separation_params(profile), "format": output_format}
+            # הפרדה בקטעים נותנת סטמים אחרים - מפתח נפרד (מפתחות רגילים לא משתנים)
+            if progressive:
+                params.update(get_progressive_params())
+            return make_cache_key(content_hash, params)
+
+        # בדיקת מטמון - אותו תוכן ואותם פרמטרים לא עוברים הפרדה שוב
+        # ב-auto כל פרופיל מותר מתאים, מהאיכותי ביותר
+        if cache is not None:
+            job.update("cache_lookup", 0.01)
+            for profile in candidate_profiles(quality):
+                with trace.span("cache_lookup", profile=profile):
+                    analysis = cache.restore(cache_key_for(profile), job_dir)
+                if analysis is None:
+                    continue
+                CACHE_LOOKUPS.inc(result="hit")
+                check_duration(analysis["duration_sec"], max_duration)
+                write_job_meta(job_dir, cache_key_for(profile), output_format)
+                if progressive:
+                    # אין מה להזרים - הלקוח מופנה לקבצים הסופיים
+                    (job_dir / STREAM_DIR).mkdir(exist_ok=True)
+                    (job_dir / STREAM_DIR / DONE_MARKER).touch()
+                return build_response(job_id, job_dir, analysis, cached=True, output_format=output_format,
+                                      quality=profile_choice(quality, profile))
+            CACHE_LOOKUPS.inc(result="miss")
+
+        # בדיקת משך לפני כל עיבוד יקר - שירים ארוכים נדחים לפני Demucs
+        with trace.span("probe"):
+            duration = probe_duration(input_path)
+        if duration is not None:
+            check_duration(duration, max_duration)
+
+        # פענוח יחיד של הקובץ - משותף להפרדה ולניתוח
+        job.update("decoding", 0.03)
+        with trace.span("decode") as span:
+            ctx = PipelineContext(input_path)
+            span["audio_sec"] = round(ctx.duration, 1)
+        check_duration(ctx.duration, max_duration)
+
+        # בחירת פרופיל האיכות לפי אורך השיר והעבודות שממתינות אחריה
+        choice = choose_profile(quality, ctx.duration, queue_depth() if queue_depth else 0, MAX_WORKERS)
+        params = get_separation_params(choice["profile"])
+        cache_key = cache_key_for(choice["profile"])
+        print(f"🎛️  פרופיל איכות: {choice['profile']} (ביקשו {quality}, הערכה {choice['estimated_sec']}s)")
+
+        # ניתוח BPM ו-Key על CPU במקביל להפרדה
+        analysis_future = analysis_pool.submit(trace.call, "analyze", run_analysis, ctx)
+
+        try:
+            # הפרדה בזיכרון
+            job.update("separating", 0.05)
+            separate_start = time.time()
+            with trace.span("separate", profile=choice["profile"], progressive=progressive):
+                if progressive:
+                    stems = separate_to_stream(job, ctx, job_dir / STREAM_DIR, params)
+                else:
+                    stems = separate_array(ctx.audio, params)
+            COST_MODEL.observe(ctx.duration, params["shifts"], time.time() - separate_start)
+
+            # Post-processing לכל סטם וקידוד אחד של הקבצים הסופיים
+            job.update("postprocessing", 0.7)
+            with trace.span("postprocess", format=output_format):
+                postprocess_stem_arrays(stems, ctx.sr, job_dir, output_format=output_format, previews=True)
+        except Exception:
+            analysis_future.cancel()
+            raise
+
+        job.update("analyzing", 0.95)
+        with trace.span("analyze_wait"):
+            analysis = analysis_future.result()
+
+        if cache is not None:
+            with trace.span("cache_store"):
+                cache.store(cache_key, job_dir, list(stem_files(output_format).values()) + preview_files(STEM_NAMES), analysis)
+        write_job_meta(job_dir, cache_key, output_format)
+
+        print(f"הושלם עיבוד job {job_id}: BPM={analysis['bpm']}, Key={analysis['key']}, Duration={analysis['duration_sec']}s")
+        response = build_response(job_id, job_dir, analysis, cached=False, output_format=output_format, quality=choice)
+        STEM_BYTES.inc(sum(info["size_bytes"] for info in response["stem_files"].values()), format=output_format)
+        if progressive:
+            # הזרם כבר לא נחוץ - בקשות חדשות מופנות לקבצים הסופיים
+            release_stream(job_dir / STREAM_DIR)
+        return response
+
+    except Exception:
+        # ניקוי במקרה של שגיאה
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise
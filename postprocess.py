@@ -1,21 +1,32 @@
+import os
 import numpy as np
 import librosa
 import soundfile as sf
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import Callable, Dict, Iterator, Optional, Tuple
 import scipy.signal
 
-async def postprocess_stems(stems_paths: Dict[str, Path]) -> Dict[str, Path]:
+from encode import DEFAULT_OUTPUT_FORMAT, StemWriter, stem_filename, write_stem
+from preview import PreviewWriter, write_preview
+
+# מספר הסטמים שמעובדים במקביל (scipy/numpy משחררים את ה-GIL בחישובים הכבדים)
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS", "4"))
+
+# סטמים ארוכים מזה מעובדים בבלוקים (מהדיסק או מהזיכרון) בלי עותקים מלאים נוספים
+STREAMING_MIN_DURATION = float(os.getenv("STREAMING_POSTPROCESS_MIN_SEC", "600"))
+STREAMING_BLOCK_SIZE = int(os.getenv("STREAMING_POSTPROCESS_BLOCK", str(44100 * 10)))
+
+def postprocess_stems(stems_paths: Dict[str, Path], max_workers: Optional[int] = None) -> Dict[str, Path]:
     """
     עיבוד מתקדם של כל הסטמים לשיפור איכות
     """
-    processed_paths = {}
-    
     try:
-        for stem_name, path in stems_paths.items():
-            print(f"מעבד סטם: {stem_name}")
-            processed_path = await process_single_stem(path, stem_name)
-            processed_paths[stem_name] = processed_path
+        processed_paths = _run_parallel(
+            {stem_name: (process_single_stem, (path, stem_name)) for stem_name, path in stems_paths.items()},
+            max_workers,
+        )
         
         print(f"Post-processing הושלם עבור {len(processed_paths)} סטמים")
         return processed_paths
@@ -24,36 +35,281 @@ async def postprocess_stems(stems_paths: Dict[str, Path]) -> Dict[str, Path]:
         print(f"שגיאה ב-post-processing: {str(e)}")
         raise
 
-async def process_single_stem(input_path: Path, stem_type: str) -> Path:
+def postprocess_stem_arrays(
+    stems: Dict[str, np.ndarray],
+    sr: int,
+    output_dir: Path,
+    max_workers: Optional[int] = None,
+    output_format: str = DEFAULT_OUTPUT_FORMAT,
+    previews: bool = False,
+) -> Dict[str, Path]:
     """
-    עיבוד סטם יחיד
+    עיבוד סטמים שכבר נמצאים בזיכרון וכתיבה אחת של הקובץ הסופי לכל סטם בפורמט המבוקש
+    previews - כתיבת פירמידת ה-peaks מהסטם המעובד לצד הקובץ הסופי (עותק ה-PCM לקטעים נבנה רק לפי בקשה)
     """
     try:
-        # קריאת הקובץ
-        audio, sr = librosa.load(str(input_path), sr=44100, mono=False)
-        
-        # וידוא שהשמע הוא stereo
-        if audio.ndim == 1:
-            audio = np.stack([audio, audio])
-        
-        # שלב 1: Loudness Normalization ל--14 LUFS
-        audio = normalize_loudness(audio, sr)
-        
-        # שלב 2: סינון תדרים לפי סוג הסטם
-        audio = apply_frequency_filtering(audio, sr, stem_type)
+        tasks = {}
+        for stem_name in list(stems.keys()):
+            output_path = output_dir / stem_filename(stem_name, output_format)
+            audio = stems.pop(stem_name)
+            if audio.shape[-1] / sr >= STREAMING_MIN_DURATION:
+                # שיר ארוך - עיבוד בבלוקים ישר לקידוד ולתצוגה, בלי קובץ ביניים בדיסק
+                tasks[stem_name] = (_process_blocks_and_encode, (audio, sr, stem_name, output_path, output_format, previews))
+            else:
+                tasks[stem_name] = (_process_and_write, (audio, sr, stem_name, output_path, output_format, previews))
         
-        # שלב 3: Denoise עדין
-        audio = gentle_denoise(audio, sr)
+        processed_paths = _run_parallel(tasks, max_workers)
         
-        # שלב 4: Phase Alignment
-        audio = phase_alignment(audio)
+        print(f"Post-processing הושלם עבור {len(processed_paths)} סטמים")
+        return processed_paths
         
-        # שלב 5: Fade-in/out ו-Trimming
-        audio = apply_fades(audio, sr)
+    except Exception as e:
+        print(f"שגיאה ב-post-processing: {str(e)}")
+        raise
+
+def _run_parallel(tasks: Dict[str, tuple], max_workers: Optional[int] = None) -> Dict[str, Path]:
+    """
+    הרצת עיבוד הסטמים ב-thread pool - max_workers=1 שומר על ריצה סדרתית
+    """
+    workers = min(max_workers or POSTPROCESS_WORKERS, len(tasks)) or 1
+    
+    if workers == 1:
+        return {stem_name: fn(*args) for stem_name, (fn, args) in tasks.items()}
+    
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="musicray-postprocess") as pool:
+        futures = {stem_name: pool.submit(fn, *args) for stem_name, (fn, args) in tasks.items()}
+        return {stem_name: future.result() for stem_name, future in futures.items()}
+
+def _process_and_write(
+    audio: np.ndarray,
+    sr: int,
+    stem_name: str,
+    output_path: Path,
+    output_format: str = DEFAULT_OUTPUT_FORMAT,
+    preview: bool = False,
+) -> Path:
+    """
+    עיבוד סטם בזיכרון וקידוד הקובץ הסופי
+    """
+    print(f"מעבד סטם: {stem_name}")
+    audio = process_stem_array(audio, sr, stem_name)
+    if preview:
+        write_preview(audio, sr, output_path.parent, stem_name, pcm=False)
+    return write_stem(audio, sr, output_path, output_format)
+
+def _process_blocks_and_encode(
+    audio: np.ndarray,
+    sr: int,
+    stem_name: str,
+    output_path: Path,
+    output_format: str = DEFAULT_OUTPUT_FORMAT,
+    preview: bool = False,
+) -> Path:
+    """
+    עיבוד סטם ארוך מהזיכרון בבלוקים, כשכל בלוק מעובד נכתב ישר לקובץ הסופי ולתצוגה
+    """
+    print(f"מעבד סטם: {stem_name}")
+    if audio.ndim == 1:
+        audio = audio[None, :]
+    preview_writer = PreviewWriter(output_path.parent, stem_name, sr, pcm=False) if preview else None
+    try:
+        with StemWriter(output_path, sr, 2, output_format) as out:
+            def write(block: np.ndarray) -> None:
+                out.write(block)
+                if preview_writer is not None:
+                    preview_writer.write(block)
+            
+            process_stem_blocks(lambda: _array_blocks(audio, STREAMING_BLOCK_SIZE), sr, audio.shape[1], stem_name, write)
+        if preview_writer is not None:
+            preview_writer.close()
+    except Exception:
+        if preview_writer is not None:
+            preview_writer.abort()
+        raise
+    return output_path
+
+def process_stem_array(audio: np.ndarray, sr: int, stem_type: str) -> np.ndarray:
+    """
+    שרשרת העיבוד על מערך סטם (channels, samples) - מנוע מאוחד ב-float32
+    """
+    return process_stem_fused(audio, sr, stem_type)
+
+def process_stem_staged(audio: np.ndarray, sr: int, stem_type: str) -> np.ndarray:
+    """
+    שרשרת העיבוד המקורית, שלב אחרי שלב (לבדיקות השוואה ו-benchmark)
+    """
+    # וידוא שהשמע הוא stereo
+    if audio.ndim == 1:
+        audio = np.stack([audio, audio])
+    
+    # שלב 1: Loudness Normalization ל--14 LUFS
+    audio = normalize_loudness(audio, sr)
+    
+    # שלב 2: סינון תדרים לפי סוג הסטם
+    audio = apply_frequency_filtering(audio, sr, stem_type)
+    
+    # שלב 3: Denoise עדין
+    audio = gentle_denoise(audio, sr)
+    
+    # שלב 4: Phase Alignment
+    audio = phase_alignment(audio)
+    
+    # שלב 5: Fade-in/out ו-Trimming
+    audio = apply_fades(audio, sr)
+    
+    return audio
+
+# סינון לפי סוג סטם: (סוג מסנן, תדר חיתוך, סדר)
+STEM_FILTERS = {
+    "vocals": ("high", 80.0, 2),   # HPF ב-80Hz לווקלס
+    "bass": ("low", 8000.0, 2),    # LPF ב-8kHz לבס
+    "drums": ("high", 30.0, 1),    # HPF עדין ב-30Hz לתופים
+}
+
+@lru_cache(maxsize=64)
+def get_filter_sos(sr: int, cutoff: float, order: int, btype: str) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    מקדמי Butterworth בצורת SOS ב-float32, מצב התחלתי (zi) ואורך ה-padding
+    מחושבים פעם אחת לכל (sr, cutoff, order)
+    """
+    sos = scipy.signal.butter(order, cutoff / (sr / 2), btype=btype, output='sos')
+    zi = scipy.signal.sosfilt_zi(sos)
+    # אותו padlen כמו ברירת המחדל של scipy.signal.sosfiltfilt
+    ntaps = 2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+    return sos.astype(np.float32), zi.astype(np.float32), 3 * int(ntaps)
+
+def sosfiltfilt_f32(audio: np.ndarray, sos: np.ndarray, zi: np.ndarray, padlen: int) -> np.ndarray:
+    """
+    סינון zero-phase (כמו sosfiltfilt) על כל הערוצים יחד, כולו ב-float32
+    scipy.signal.sosfiltfilt מקדם ל-float64 ומכפיל את הזיכרון בכל שלב ביניים
+    """
+    if audio.shape[-1] <= padlen:
+        return scipy.signal.sosfiltfilt(sos, audio, axis=-1).astype(np.float32)
+    
+    # הרחבה אי-זוגית בקצוות (odd extension) למניעת transients
+    ext = np.concatenate([
+        2 * audio[:, :1] - audio[:, padlen:0:-1],
+        audio,
+        2 * audio[:, -1:] - audio[:, -2:-padlen - 2:-1],
+    ], axis=-1)
+    
+    # מעבר קדימה
+    y, _ = scipy.signal.sosfilt(sos, ext, axis=-1, zi=zi[:, None, :] * ext[None, :, :1])
+    del ext
+    
+    # מעבר אחורה
+    y = y[:, ::-1]
+    y, _ = scipy.signal.sosfilt(sos, y, axis=-1, zi=zi[:, None, :] * y[None, :, :1])
+    
+    return np.ascontiguousarray(y[:, -padlen - 1:padlen - 1:-1])
+
+@lru_cache(maxsize=16)
+def get_fade_ramps(sr: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    רמפות fade-in/out של 10ms ב-float32
+    """
+    fade_samples = int(0.01 * sr)
+    fade_in = np.linspace(0, 1, fade_samples, dtype=np.float32)
+    fade_out = fade_in[::-1].copy()
+    fade_in.setflags(write=False)
+    fade_out.setflags(write=False)
+    return fade_in, fade_out
+
+def _rms(audio: np.ndarray) -> float:
+    """
+    RMS בלי להקצות מערך ביניים בגודל האות
+    """
+    flat = audio.reshape(-1)
+    if flat.size == 0:
+        return 0.0
+    return float(np.sqrt(float(np.dot(flat, flat)) / flat.size))
+
+def _peak(audio: np.ndarray) -> float:
+    if audio.size == 0:
+        return 0.0
+    return float(max(audio.max(), -audio.min()))
+
+def _loudness_gain(rms: float, peak: float, target_lufs: float) -> float:
+    """
+    gain לנורמליזציה (קירוב פשוט ל-LUFS) כולל הגבלת peak ל-0.95
+    """
+    if rms < 1e-6:  # שמע שקט מדי
+        return 1.0
+    gain_db = np.clip((target_lufs + 23) - 20 * np.log10(rms), -20, 20)
+    gain = 10 ** (gain_db / 20)
+    if peak * gain > 0.95:
+        gain = 0.95 / peak
+    return float(gain)
+
+def process_stem_fused(audio: np.ndarray, sr: int, stem_type: str, target_lufs: float = -14.0) -> np.ndarray:
+    """
+    כל חמשת שלבי העיבוד במעבר אחד על מאגר float32 יחיד:
+    gain + הגבלת peak בהכפלה אחת, sosfiltfilt על כל הערוצים יחד (axis=-1),
+    noise gate, יישור פאזה ו-fades - הכל in-place חוץ מהסינון עצמו
+    (מערך float32 שמתקבל עשוי להשתנות במקום)
+    """
+    audio = np.asarray(audio, dtype=np.float32)
+    if audio.ndim == 1:
+        audio = np.stack([audio, audio])
+    elif not audio.flags.writeable:
+        audio = audio.copy()
+    
+    # שלב 1: Loudness Normalization - gain והגבלת clipping כמכפלה אחת
+    gain = _loudness_gain(_rms(audio), _peak(audio), target_lufs)
+    if gain != 1.0:
+        audio *= np.float32(gain)
+    
+    # שלב 2: סינון תדרים - SOS יציב נומרית, שני הערוצים בקריאה אחת (axis=-1)
+    if stem_type in STEM_FILTERS:
+        btype, cutoff, order = STEM_FILTERS[stem_type]
+        try:
+            sos, zi, padlen = get_filter_sos(sr, cutoff, order, btype)
+            audio = sosfiltfilt_f32(audio, sos, zi, padlen)
+        except Exception as e:
+            print(f"שגיאה בסינון תדרים עבור {stem_type}: {str(e)}")
+    
+    # שלב 3: Denoise עדין - מסכה בוליאנית במקום מערך abs מלא
+    rms = _rms(audio)
+    if rms < 0.01:
+        gate_threshold = rms * 0.1
+        mask = audio > gate_threshold
+        mask |= audio < -gate_threshold
+        np.multiply(audio, mask, out=audio)
+        del mask
+    
+    # שלב 4: Phase Alignment
+    audio = phase_alignment(audio)
+    
+    # שלב 5: Fades עם רמפות מחושבות מראש
+    fade_in, fade_out = get_fade_ramps(sr)
+    fade_samples = fade_in.shape[0]
+    if audio.shape[1] > fade_samples * 2:
+        audio[:, :fade_samples] *= fade_in
+        audio[:, -fade_samples:] *= fade_out
+    
+    return audio
+
+def process_single_stem(input_path: Path, stem_type: str) -> Path:
+    """
+    עיבוד סטם יחיד
+    """
+    try:
+        print(f"מעבד סטם: {stem_type}")
         
-        # שמירת הקובץ המעובד
         output_path = input_path.parent / f"{stem_type}_processed.wav"
-        sf.write(str(output_path), audio.T, sr, subtype='FLOAT')
+        
+        info = sf.info(str(input_path))
+        if info.duration >= STREAMING_MIN_DURATION:
+            # סטם ארוך - עיבוד בבלוקים עם זיכרון קבוע
+            process_stem_file_streaming(input_path, output_path, stem_type)
+        else:
+            # קריאת הקובץ
+            audio, sr = librosa.load(str(input_path), sr=44100, mono=False)
+            
+            audio = process_stem_array(audio, sr, stem_type)
+            
+            # שמירת הקובץ המעובד
+            sf.write(str(output_path), audio.T, sr, subtype='FLOAT')
         
         # החלפת הקובץ המקורי
         input_path.unlink()  # מחיקת המקורי
@@ -65,6 +321,171 @@ async def process_single_stem(input_path: Path, stem_type: str) -> Path:
         print(f"שגיאה בעיבוד סטם {stem_type}: {str(e)}")
         raise
 
+@lru_cache(maxsize=64)
+def get_streaming_sos(sr: int, cutoff: float, order: int, btype: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    המסנן פעמיים ברצף (causal) - אותה תגובת עוצמה כמו filtfilt, בלי צורך בכל האות
+    """
+    sos = scipy.signal.butter(order, cutoff / (sr / 2), btype=btype, output='sos')
+    sos = np.vstack([sos, sos])
+    return sos, scipy.signal.sosfilt_zi(sos)
+
+class _StreamFilter:
+    """
+    מסנן SOS עם מצב שנשמר בין בלוקים
+    """
+    
+    def __init__(self, sr: int, stem_type: str):
+        self.sos = None
+        self.zi = None
+        self._zi_unit = None
+        if stem_type in STEM_FILTERS:
+            btype, cutoff, order = STEM_FILTERS[stem_type]
+            self.sos, self._zi_unit = get_streaming_sos(sr, cutoff, order, btype)
+    
+    def __call__(self, block: np.ndarray) -> np.ndarray:
+        if self.sos is None:
+            return block
+        if self.zi is None:
+            # מצב התחלתי יציב לפי הדגימה הראשונה (בלי transient בהתחלה)
+            self.zi = self._zi_unit[:, None, :] * block[None, :, :1].astype(np.float64)
+        filtered, self.zi = scipy.signal.sosfilt(self.sos, block, axis=-1, zi=self.zi)
+        return filtered.astype(np.float32, copy=False)
+
+def _read_blocks(path: Path, block_size: int):
+    """
+    קריאת קובץ בבלוקים בצורה (2, frames) ב-float32
+    """
+    with sf.SoundFile(str(path)) as f:
+        for block in f.blocks(blocksize=block_size, dtype='float32', always_2d=True):
+            block = block.T
+            if block.shape[0] == 1:
+                block = np.concatenate([block, block])
+            yield np.ascontiguousarray(block[:2])
+
+def _array_blocks(audio: np.ndarray, block_size: int):
+    """
+    בלוקים (2, frames) ב-float32 ממערך בזיכרון - עותק לכל בלוק, המקור לא משתנה
+    """
+    for start in range(0, audio.shape[1], block_size):
+        block = np.array(audio[:2, start:start + block_size], dtype=np.float32)
+        if block.shape[0] == 1:
+            block = np.concatenate([block, block])
+        yield block
+
+def process_stem_file_streaming(
+    input_path: Path,
+    output_path: Path,
+    stem_type: str,
+    block_size: int = STREAMING_BLOCK_SIZE,
+    target_lufs: float = -14.0,
+) -> Path:
+    """
+    עיבוד סטם מקובץ לקובץ בבלוקים - זיכרון קבוע ללא תלות באורך השיר
+    """
+    info = sf.info(str(input_path))
+    with sf.SoundFile(str(output_path), 'w', samplerate=info.samplerate, channels=2, subtype='FLOAT') as out:
+        process_stem_blocks(
+            lambda: _read_blocks(input_path, block_size), info.samplerate, info.frames, stem_type,
+            lambda block: out.write(block.T), target_lufs,
+        )
+    return output_path
+
+def process_stem_blocks(
+    blocks: Callable[[], Iterator[np.ndarray]],
+    sr: int,
+    total: int,
+    stem_type: str,
+    write: Callable[[np.ndarray], None],
+    target_lufs: float = -14.0,
+) -> None:
+    """
+    שרשרת העיבוד בבלוקים (2, frames) - blocks() מחזיר איטרטור חדש לכל מעבר, write מקבל כל בלוק מעובד
+    מעבר 1: מדידת RMS/peak של המקור ו-RMS אחרי הסינון (לנורמליזציה ול-gate)
+    מעבר 2: gain, סינון stateful, gate, יישור פאזה ו-fades
+    """
+    # מעבר 1 - סטטיסטיקות עוצמה
+    sumsq = 0.0
+    filtered_sumsq = 0.0
+    peak = 0.0
+    stream_filter = _StreamFilter(sr, stem_type)
+    for block in blocks():
+        flat = block.reshape(-1)
+        sumsq += float(np.dot(flat, flat))
+        peak = max(peak, _peak(block))
+        filtered = stream_filter(block).reshape(-1)
+        filtered_sumsq += float(np.dot(filtered, filtered))
+    
+    count = max(total * 2, 1)
+    gain = np.float32(_loudness_gain(np.sqrt(sumsq / count), peak, target_lufs))
+    
+    # ה-filter לינארי, לכן RMS אחרי gain = gain * RMS מסונן
+    gate_rms = float(gain) * np.sqrt(filtered_sumsq / count)
+    gate_threshold = gate_rms * 0.1 if gate_rms < 0.01 else None
+    
+    fade_in, fade_out = get_fade_ramps(sr)
+    fade_samples = fade_in.shape[0]
+    apply_fade = total > fade_samples * 2
+    
+    # מעבר 2 - עיבוד וכתיבה
+    stream_filter = _StreamFilter(sr, stem_type)
+    delay_lines = None
+    position = 0
+    for block in blocks():
+        block *= gain
+        block = stream_filter(block)
+        
+        if gate_threshold is not None:
+            mask = block > gate_threshold
+            mask |= block < -gate_threshold
+            np.multiply(block, mask, out=block)
+        
+        # יישור פאזה - העיכוב נמדד על הבלוק הראשון ומיושם כ-delay line
+        if delay_lines is None:
+            delay = _channel_delay(block)
+            # כמו phase_alignment: עיכוב חיובי (ערוץ 0 מאחר) מעכב את ערוץ 1
+            delay_lines = [
+                np.zeros(max(-delay, 0), dtype=np.float32),
+                np.zeros(max(delay, 0), dtype=np.float32),
+            ]
+        for ch, line in enumerate(delay_lines):
+            if line.size:
+                joined = np.concatenate([line, block[ch]])
+                block[ch] = joined[:block.shape[1]]
+                delay_lines[ch] = joined[block.shape[1]:]
+        
+        if apply_fade:
+            _fade_block(block, position, total, fade_in, fade_out)
+        
+        write(block)
+        position += block.shape[1]
+
+def _channel_delay(audio: np.ndarray) -> int:
+    """
+    עיכוב בין ערוצים (כמו phase_alignment) - 0 אם אין צורך בתיקון
+    """
+    if audio.shape[0] != 2:
+        return 0
+    correlation = np.correlate(audio[0][:1000], audio[1][:1000], mode='full')
+    delay = int(np.argmax(correlation) - len(audio[1][:1000]) + 1)
+    return delay if abs(delay) <= 10 else 0
+
+def _fade_block(block: np.ndarray, position: int, total: int, fade_in: np.ndarray, fade_out: np.ndarray) -> None:
+    """
+    החלת fade-in/out על החלק של הבלוק שנופל בתחילת/סוף הקובץ
+    """
+    n = block.shape[1]
+    fade_samples = fade_in.shape[0]
+    
+    if position < fade_samples:
+        end = min(fade_samples - position, n)
+        block[:, :end] *= fade_in[position:position + end]
+    
+    fade_start = total - fade_samples
+    if position + n > fade_start:
+        start = max(fade_start - position, 0)
+        block[:, start:] *= fade_out[position + start - fade_start:position + n - fade_start]
+
 def normalize_loudness(audio: np.ndarray, sr: int, target_lufs: float = -14.0) -> np.ndarray:
     """
     נורמליזציה של עוצמת השמע ל-LUFS מטרה
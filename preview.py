@@ -0,0 +1,286 @@
+"""
+musicRay - אחסון סטמים לגישה אקראית: תצוגות מקדימות ו-waveform
+לכל סטם נכתבת עם העיבוד פירמידת peaks (min/max) בכמה רזולוציות (קטנה - נשמרת גם במטמון),
+ועותק PCM16 little-endian עם header קטן (נקרא ב-np.memmap) נבנה מהסטם הסופי בבקשת הקטע הראשונה -
+בקשה קצרה נוגעת רק בדפים הדרושים
+"""
+
+import os
+import struct
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+
+from progressive import streaming_wav_header
+
+PREVIEW_EXT = "pcm16"
+PEAKS_EXT = "peaks"
+
+# header של קובץ ה-PCM: magic, גרסה, ערוצים, SR, frames - מרופד ל-32 בתים
+PCM_MAGIC = b"MRPC"
+PCM_HEADER = struct.Struct("<4sHHIQ")
+PCM_HEADER_SIZE = 32
+
+# header של קובץ ה-peaks: magic, גרסה, מספר רמות, SR, frames - ואחריו (samples_per_peak, count) לכל רמה
+PEAKS_MAGIC = b"MRPK"
+PEAKS_HEADER = struct.Struct("<4sHHIQ")
+PEAKS_LEVEL = struct.Struct("<IQ")
+
+PEAK_BASE_SAMPLES = 256  # הרזולוציה העדינה ביותר
+PEAK_FACTOR = 4  # כל רמה גסה פי 4 מהקודמת
+PEAK_MIN_COUNT = 256  # לא בונים רמות עם פחות peaks מזה
+
+EXCERPT_MAX_SEC = float(os.getenv("EXCERPT_MAX_SEC", "30"))
+PEAKS_MAX_WIDTH = int(os.getenv("PEAKS_MAX_WIDTH", "10000"))
+PREVIEW_BLOCK_SIZE = 44100 * 10
+
+
+def preview_path(job_dir: Path, stem_name: str) -> Path:
+    return Path(job_dir) / f"{stem_name}.{PREVIEW_EXT}"
+
+
+def peaks_path(job_dir: Path, stem_name: str) -> Path:
+    return Path(job_dir) / f"{stem_name}.{PEAKS_EXT}"
+
+
+def preview_files(stem_names: List[str]) -> List[str]:
+    """
+    שמות קבצי התצוגה שנכתבים עם הסטמים (peaks בלבד - לשמירה במטמון לצד הסטמים)
+    """
+    return [peaks_path(Path(), name).name for name in stem_names]
+
+
+class PreviewWriter:
+    """
+    בניית peaks (ואם pcm - גם כתיבת הסטם כ-PCM16) בלוק אחרי בלוק (גם לסטמים ארוכים מהדיסק)
+    הקבצים נכתבים לשם זמני ומוחלפים באופן אטומי ב-close
+    """
+
+    def __init__(self, job_dir: Path, stem_name: str, sr: int, channels: int = 2, pcm: bool = True):
+        self.pcm_path = preview_path(job_dir, stem_name)
+        self.peaks_path = peaks_path(job_dir, stem_name)
+        self.sr = sr
+        self.channels = channels
+        self.frames = 0
+        suffix = f".{uuid.uuid4().hex}.part"
+        self._pcm_tmp = self.pcm_path.with_name(self.pcm_path.name + suffix)
+        self._peaks_tmp = self.peaks_path.with_name(self.peaks_path.name + suffix)
+        self._file = None
+        if pcm:
+            self._file = open(self._pcm_tmp, "wb")
+            self._file.write(b"\0" * PCM_HEADER_SIZE)
+        self._carry = np.zeros(0, dtype=np.int16)  # min/max של frames שעוד לא מילאו בלוק peaks
+        self._carry_max = np.zeros(0, dtype=np.int16)
+        self._peaks: List[np.ndarray] = []
+
+    def write(self, audio: np.ndarray) -> None:
+        """
+        בלוק (channels, samples) ב-float
+        """
+        pcm = (np.clip(audio, -1.0, 1.0).T * 32767).astype("<i2")
+        if self._file is not None:
+            self._file.write(pcm.tobytes())
+        self.frames += pcm.shape[0]
+
+        # peaks ב-mono: min/max על פני הערוצים, ואז על כל בלוק של PEAK_BASE_SAMPLES
+        lo = np.concatenate([self._carry, pcm.min(axis=1)])
+        hi = np.concatenate([self._carry_max, pcm.max(axis=1)])
+        full = len(lo) // PEAK_BASE_SAMPLES * PEAK_BASE_SAMPLES
+        if full:
+            self._peaks.append(np.stack([
+                lo[:full].reshape(-1, PEAK_BASE_SAMPLES).min(axis=1),
+                hi[:full].reshape(-1, PEAK_BASE_SAMPLES).max(axis=1),
+            ], axis=1))
+        self._carry, self._carry_max = lo[full:], hi[full:]
+
+    def close(self) -> None:
+        if len(self._carry):
+            self._peaks.append(np.array([[self._carry.min(), self._carry_max.max()]], dtype=np.int16))
+        if self._file is not None:
+            self._file.seek(0)
+            self._file.write(PCM_HEADER.pack(PCM_MAGIC, 1, self.channels, self.sr, self.frames))
+            self._file.close()
+
+        base = np.concatenate(self._peaks) if self._peaks else np.zeros((0, 2), dtype=np.int16)
+        levels = build_pyramid(base)
+        with open(self._peaks_tmp, "wb") as f:
+            f.write(PEAKS_HEADER.pack(PEAKS_MAGIC, 1, len(levels), self.sr, self.frames))
+            for samples_per_peak, peaks in levels:
+                f.write(PEAKS_LEVEL.pack(samples_per_peak, len(peaks)))
+            for _, peaks in levels:
+                f.write(peaks.astype("<i2").tobytes())
+
+        if self._file is not None:
+            os.replace(self._pcm_tmp, self.pcm_path)
+        os.replace(self._peaks_tmp, self.peaks_path)
+
+    def abort(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        for path in (self._pcm_tmp, self._peaks_tmp):
+            path.unlink(missing_ok=True)
+
+
+def build_pyramid(base: np.ndarray) -> List[Tuple[int, np.ndarray]]:
+    """
+    רמות (samples_per_peak, peaks) מהעדינה לגסה - כל רמה מאחדת PEAK_FACTOR peaks של הקודמת
+    """
+    levels = [(PEAK_BASE_SAMPLES, base)]
+    while len(levels[-1][1]) >= PEAK_MIN_COUNT * PEAK_FACTOR:
+        samples_per_peak, peaks = levels[-1]
+        pad = -len(peaks) % PEAK_FACTOR
+        if pad:
+            peaks = np.concatenate([peaks, np.repeat(peaks[-1:], pad, axis=0)])
+        grouped = peaks.reshape(-1, PEAK_FACTOR, 2)
+        levels.append((samples_per_peak * PEAK_FACTOR, np.stack([
+            grouped[:, :, 0].min(axis=1), grouped[:, :, 1].max(axis=1)
+        ], axis=1)))
+    return levels
+
+
+def write_preview(audio: np.ndarray, sr: int, job_dir: Path, stem_name: str, pcm: bool = True) -> Path:
+    """
+    קבצי התצוגה לסטם שנמצא בזיכרון (channels, samples) - pcm=False כותב רק peaks
+    """
+    writer = PreviewWriter(job_dir, stem_name, sr, audio.shape[0], pcm)
+    try:
+        for start in range(0, audio.shape[1], PREVIEW_BLOCK_SIZE):
+            writer.write(audio[:, start:start + PREVIEW_BLOCK_SIZE])
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    return writer.peaks_path
+
+
+def write_preview_from_file(input_path: Path, job_dir: Path, stem_name: str, pcm: bool = True) -> Path:
+    """
+    קבצי התצוגה מקובץ שמע, בבלוקים - זיכרון קבוע (PCM לקטעים, או jobs ישנים בלי peaks)
+    """
+    with sf.SoundFile(str(input_path)) as f:
+        writer = PreviewWriter(job_dir, stem_name, f.samplerate, f.channels, pcm)
+        try:
+            for block in f.blocks(blocksize=PREVIEW_BLOCK_SIZE, dtype="float32", always_2d=True):
+                writer.write(block.T)
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+    return writer.peaks_path
+
+
+def open_preview(job_dir: Path, stem_name: str) -> Tuple[np.memmap, int]:
+    """
+    ה-PCM של הסטם כ-memmap בצורה (frames, channels) ו-SR
+    """
+    path = preview_path(job_dir, stem_name)
+    with open(path, "rb") as f:
+        magic, _, channels, sr, frames = PCM_HEADER.unpack(f.read(PCM_HEADER.size))
+    if magic != PCM_MAGIC:
+        raise ValueError(f"קובץ תצוגה לא תקין: {path.name}")
+    if frames == 0:
+        return np.zeros((0, channels), dtype="<i2"), sr
+    return np.memmap(path, dtype="<i2", mode="r", offset=PCM_HEADER_SIZE, shape=(frames, channels)), sr
+
+
+def open_peaks(job_dir: Path, stem_name: str) -> Tuple[List[Tuple[int, np.ndarray]], int, int]:
+    """
+    רמות ה-peaks כ-memmap (samples_per_peak, (count, 2)), SR ומספר frames
+    """
+    path = peaks_path(job_dir, stem_name)
+    with open(path, "rb") as f:
+        magic, _, n_levels, sr, frames = PEAKS_HEADER.unpack(f.read(PEAKS_HEADER.size))
+        if magic != PEAKS_MAGIC:
+            raise ValueError(f"קובץ peaks לא תקין: {path.name}")
+        table = [PEAKS_LEVEL.unpack(f.read(PEAKS_LEVEL.size)) for _ in range(n_levels)]
+
+    levels = []
+    offset = PEAKS_HEADER.size + PEAKS_LEVEL.size * n_levels
+    for samples_per_peak, count in table:
+        if count:
+            peaks = np.memmap(path, dtype="<i2", mode="r", offset=offset, shape=(count, 2))
+        else:
+            peaks = np.zeros((0, 2), dtype="<i2")
+        levels.append((samples_per_peak, peaks))
+        offset += count * 4
+    return levels, sr, frames
+
+
+def _frame_range(start_sec: float, end_sec: Optional[float], sr: int, frames: int) -> Tuple[int, int]:
+    """
+    טווח frames מתוך שניות - ValueError לטווח לא תקין
+    """
+    if start_sec < 0 or (end_sec is not None and end_sec <= start_sec):
+        raise ValueError("טווח זמן לא תקין")
+    start = min(int(start_sec * sr), frames)
+    end = frames if end_sec is None else min(int(end_sec * sr), frames)
+    if start >= end:
+        raise ValueError("הטווח מחוץ לאורך הסטם")
+    return start, end
+
+
+def read_excerpt(job_dir: Path, stem_name: str, start_sec: float, end_sec: Optional[float] = None) -> bytes:
+    """
+    קטע של הסטם כ-WAV PCM16 - נקראים רק הדפים של הטווח המבוקש
+    """
+    pcm, sr = open_preview(job_dir, stem_name)
+    if end_sec is None:
+        end_sec = start_sec + EXCERPT_MAX_SEC
+    if end_sec - start_sec > EXCERPT_MAX_SEC:
+        raise ValueError(f"קטע ארוך מדי - מקסימום {EXCERPT_MAX_SEC:.0f} שניות")
+    start, end = _frame_range(start_sec, end_sec, sr, pcm.shape[0])
+    data = pcm[start:end].tobytes()
+    return streaming_wav_header(sr, pcm.shape[1], len(data)) + data
+
+
+def read_peaks(job_dir: Path, stem_name: str, width: int, start_sec: float = 0.0, end_sec: Optional[float] = None) -> Dict[str, Any]:
+    """
+    waveform של width פיקסלים לטווח המבוקש, בפורמט JSON של audiowaveform (data: min, max לסירוגין)
+    נבחרת הרמה הגסה ביותר שעדיין נותנת לפחות peak אחד לפיקסל
+    """
+    if not 1 <= width <= PEAKS_MAX_WIDTH:
+        raise ValueError(f"width חייב להיות בין 1 ל-{PEAKS_MAX_WIDTH}")
+    levels, sr, frames = open_peaks(job_dir, stem_name)
+    start, end = _frame_range(start_sec, end_sec, sr, frames)
+
+    samples_per_peak, peaks = levels[0]
+    for level_spp, level_peaks in levels:
+        if (end - start) / level_spp >= width:
+            samples_per_peak, peaks = level_spp, level_peaks
+
+    first = start // samples_per_peak
+    last = min(-(-end // samples_per_peak), len(peaks))
+    window = np.asarray(peaks[first:last])
+    if len(window) > width:
+        edges = np.linspace(0, len(window), width + 1).astype(np.int64)[:-1]
+        window = np.stack([
+            np.minimum.reduceat(window[:, 0], edges), np.maximum.reduceat(window[:, 1], edges)
+        ], axis=1)
+
+    return {
+        "version": 2,
+        "channels": 1,
+        "sample_rate": sr,
+        "samples_per_pixel": int(round((end - start) / max(len(window), 1))),
+        "bits": 16,
+        "length": len(window),
+        "start_sec": round(start / sr, 3),
+        "end_sec": round(end / sr, 3),
+        "data": window.reshape(-1).tolist(),
+    }
+
+
+def ensure_preview(job_dir: Path, stem_name: str, stem_file: Path, pcm: bool = False) -> None:
+    """
+    בניית קבצי התצוגה מהסטם הסופי אם חסרים - ה-PCM רק כש-pcm (בקשת קטע),
+    ה-peaks גם ל-jobs ותוצאות מטמון מלפני אחסון התצוגה
+    """
+    if pcm and not preview_path(job_dir, stem_name).exists():
+        print(f"בונה עותק PCM לסטם {stem_name} מ-{stem_file.name}")
+        write_preview_from_file(stem_file, job_dir, stem_name)
+    elif not peaks_path(job_dir, stem_name).exists():
+        print(f"בונה peaks לסטם {stem_name} מ-{stem_file.name}")
+        write_preview_from_file(stem_file, job_dir, stem_name, pcm=False)
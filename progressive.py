@@ -0,0 +1,156 @@
+"""
+musicRay - מסירה הדרגתית של סטמים (progressive delivery)
+ה-worker כותב כל קטע מופרד כ-PCM16 לקובץ שגדל, וה-API מזרים אותו ללקוח ב-chunked HTTP
+"""
+
+import asyncio
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional, Set
+
+import numpy as np
+
+from engine import STEM_NAMES
+
+STREAM_DIR = "stream"
+DONE_MARKER = ".done"
+STREAM_CHUNK_SIZE = 256 * 1024
+STREAM_POLL_INTERVAL = 0.2
+
+# אחרי סיום ה-job קבצי הזרם מיותרים (יש קבצים סופיים ותצוגות) - נמחקים כשהקוראים נסגרים,
+# ולכל המאוחר אחרי זמן החסד כדי שלקוח תקוע לא ישאיר עותק PCM מלא בדיסק
+STREAM_GRACE_SEC = float(os.getenv("STREAM_GRACE_SEC", "600"))
+
+_readers: Dict[str, int] = {}
+_released: Set[str] = set()
+_readers_lock = threading.Lock()
+
+
+def stream_part_path(stream_dir: Path, stem_name: str) -> Path:
+    return stream_dir / f"{stem_name}.pcm"
+
+
+def streaming_wav_header(sr: int, channels: int = 2, data_size: Optional[int] = None) -> bytes:
+    """
+    header של WAV PCM16 - בלי data_size האורך לא ידוע (0xFFFFFFFF) ונגנים מנגנים עד סוף הזרם
+    """
+    block_align = channels * 2
+    riff_size = 0xFFFFFFFF if data_size is None else 36 + data_size
+    return b"".join([
+        b"RIFF", struct.pack("<I", riff_size), b"WAVE",
+        b"fmt ", struct.pack("<IHHIIHH", 16, 1, channels, sr, sr * block_align, block_align, 16),
+        b"data", struct.pack("<I", 0xFFFFFFFF if data_size is None else data_size),
+    ])
+
+
+class StemStreamWriter:
+    """
+    כתיבת קטעי הסטמים לפי הסדר כ-PCM16 interleaved, קובץ אחד לכל סטם
+    """
+
+    def __init__(self, stream_dir: Path):
+        self.stream_dir = Path(stream_dir)
+        self.stream_dir.mkdir(parents=True, exist_ok=True)
+        self._files = {name: open(stream_part_path(self.stream_dir, name), "ab") for name in STEM_NAMES}
+
+    def write(self, chunk: Dict[str, np.ndarray]) -> None:
+        for name, audio in chunk.items():
+            pcm = (np.clip(audio, -1.0, 1.0).T * 32767).astype("<i2")
+            f = self._files[name]
+            f.write(pcm.tobytes())
+            f.flush()
+
+    def close(self) -> None:
+        """
+        סגירת הקבצים וסימון סוף הזרם (גם כשההפרדה נכשלה - כדי שהלקוחות לא ימתינו)
+        """
+        for f in self._files.values():
+            f.close()
+        (self.stream_dir / DONE_MARKER).touch()
+
+
+def _stream_key(stream_dir: Path) -> str:
+    return os.path.abspath(stream_dir)
+
+
+def _remove_parts(stream_dir: Path) -> None:
+    """
+    מחיקת קבצי ה-PCM - התיקייה וסימון הסיום נשארים, ובקשות חדשות מופנות לקבצים הסופיים
+    """
+    for name in STEM_NAMES:
+        try:
+            stream_part_path(Path(stream_dir), name).unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _expire_stream(stream_dir: Path) -> None:
+    with _readers_lock:
+        if _stream_key(stream_dir) not in _released:
+            return
+        _released.discard(_stream_key(stream_dir))
+    _remove_parts(stream_dir)
+
+
+def release_stream(stream_dir: Path, grace_sec: float = STREAM_GRACE_SEC) -> None:
+    """
+    ה-job הסתיים: קבצי הזרם נמחקים מיד אם אין קוראים, אחרת כשהקורא האחרון נסגר או אחרי grace_sec
+    """
+    key = _stream_key(stream_dir)
+    with _readers_lock:
+        if _readers.get(key):
+            _released.add(key)
+            timer = threading.Timer(grace_sec, _expire_stream, (Path(stream_dir),))
+            timer.daemon = True
+            timer.start()
+            return
+    _remove_parts(stream_dir)
+
+
+def _read_from(path: Path, offset: int, size: int) -> bytes:
+    try:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+    except FileNotFoundError:
+        return b""
+
+
+async def tail_stem_stream(stream_dir: Path, stem_name: str, sr: int) -> AsyncIterator[bytes]:
+    """
+    הזרמת הסטם בזמן שהוא נכתב: header ואז כל בית חדש, עד סימון הסיום
+    """
+    key = _stream_key(stream_dir)
+    with _readers_lock:
+        _readers[key] = _readers.get(key, 0) + 1
+    try:
+        yield streaming_wav_header(sr)
+
+        path = stream_part_path(stream_dir, stem_name)
+        done = stream_dir / DONE_MARKER
+        offset = 0
+        while True:
+            # בדיקת הסיום לפני הקריאה - כל מה שנכתב לפני הסימון ייקרא
+            finished = done.exists()
+            data = await asyncio.to_thread(_read_from, path, offset, STREAM_CHUNK_SIZE)
+            if data:
+                offset += len(data)
+                yield data
+                continue
+            if finished or not stream_dir.exists():
+                return
+            await asyncio.sleep(STREAM_POLL_INTERVAL)
+    finally:
+        # הקורא האחרון של job שהסתיים מוחק את קבצי הזרם
+        with _readers_lock:
+            _readers[key] -= 1
+            last = _readers[key] == 0
+            if last:
+                del _readers[key]
+            expired = last and key in _released
+            if expired:
+                _released.discard(key)
+        if expired:
+            _remove_parts(stream_dir)
@@ -0,0 +1,124 @@
+"""
+musicRay - פרופילי איכות להפרדה (fast / balanced / best)
+ומדיניות auto שמורידה shifts (5 -> 2 -> 1) כשעומק התור או אורך השיר יחרגו מ-SLO של זמן תגובה
+"""
+
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+from engine import DEVICE, MODEL_NAME, PRECISION, resolve_precision
+
+# GPU (או RunPod) מריץ כברירת מחדל באיכות הגבוהה, CPU במהירות
+HIGH_QUALITY_DEVICE = DEVICE == "cuda" or os.getenv("RUNPOD_POD_ID") is not None
+
+QUALITY_PROFILES: Dict[str, Dict[str, Any]] = {
+    "best": {"shifts": 5, "overlap": 0.25},
+    "balanced": {"shifts": 2, "overlap": 0.25},
+    "fast": {"shifts": 1, "overlap": 0.1},
+}
+PROFILE_LADDER = ["best", "balanced", "fast"]  # סדר ההורדה של מדיניות auto
+AUTO = "auto"
+
+# אורך פלח לפי device - פלחים קצרים חוסכים זיכרון ב-CPU
+SEGMENT = 8 if HIGH_QUALITY_DEVICE else 4
+
+DEFAULT_PROFILE = os.getenv("QUALITY_DEFAULT", "best" if HIGH_QUALITY_DEVICE else "fast").lower()
+if DEFAULT_PROFILE not in QUALITY_PROFILES:
+    raise ValueError(f"QUALITY_DEFAULT לא תקין: {DEFAULT_PROFILE}. נתמכים: {', '.join(PROFILE_LADDER)}")
+
+# זמן תגובה מקסימלי (המתנה בתור + עיבוד) שמדיניות auto מנסה לעמוד בו
+LATENCY_SLO_SEC = float(os.getenv("LATENCY_SLO_SEC", "300"))
+
+# הערכה התחלתית: שניות עיבוד לכל שנייה של שמע, לכל shift (מתעדכנת מהריצות בפועל)
+SEPARATION_RTF = float(os.getenv("SEPARATION_RTF", "0.04" if DEVICE == "cuda" else "1.0"))
+
+
+def validate_quality(name: str) -> str:
+    """
+    שם פרופיל תקין (או auto) - ValueError אחרת
+    """
+    name = name.lower()
+    if name != AUTO and name not in QUALITY_PROFILES:
+        raise ValueError(f"פרופיל איכות לא נתמך: {name}. נתמכים: {AUTO}, {', '.join(PROFILE_LADDER)}")
+    return name
+
+
+def get_profile_params(profile: str = DEFAULT_PROFILE) -> Dict[str, Any]:
+    """
+    פרמטרי Demucs לפרופיל - משמשים גם כחלק ממפתח המטמון
+    """
+    params = {"model": MODEL_NAME, **QUALITY_PROFILES[profile], "segment": SEGMENT}
+    # דיוק מופחת משנה את הפלט - חלק ממפתח המטמון (fp32 נשאר בלי שדה, למפתחות קיימים)
+    # הדיוק שהמנוע מריץ בפועל על ה-device, לא הערך הגולמי מהסביבה
+    precision = resolve_precision(PRECISION, DEVICE)
+    if precision != "fp32":
+        params["precision"] = precision
+    return params
+
+
+def candidate_profiles(requested: str) -> List[str]:
+    """
+    הפרופילים שמותר להשתמש בהם עבור הבקשה, מהאיכותי ביותר
+    auto לא עולה מעל פרופיל ברירת המחדל של ה-device
+    """
+    if requested != AUTO:
+        return [requested]
+    return PROFILE_LADDER[PROFILE_LADDER.index(DEFAULT_PROFILE):]
+
+
+class CostModel:
+    """
+    הערכת זמן ההפרדה: RTF לכל shift, ממוצע נע (EWMA) על הריצות שנמדדו
+    """
+
+    def __init__(self, rtf: float = SEPARATION_RTF, alpha: float = 0.3):
+        self.rtf = rtf
+        self.alpha = alpha
+        self._lock = threading.Lock()
+
+    def estimate(self, duration: float, shifts: int) -> float:
+        return duration * max(shifts, 1) * self.rtf
+
+    def observe(self, duration: float, shifts: int, elapsed: float) -> None:
+        if duration <= 0:
+            return
+        sample = elapsed / (duration * max(shifts, 1))
+        with self._lock:
+            self.rtf = (1 - self.alpha) * self.rtf + self.alpha * sample
+
+
+COST_MODEL = CostModel()
+
+
+def profile_choice(
+    requested: str,
+    profile: str,
+    estimated_sec: Optional[float] = None,
+    queue_depth: Optional[int] = None,
+    slo_sec: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    תיאור הפרופיל שנבחר בתשובה ללקוח - אותם שדות גם בפגיעת מטמון (None כשלא רלוונטי)
+    """
+    return {
+        "requested": requested,
+        "profile": profile,
+        "estimated_sec": estimated_sec,
+        "queue_depth": queue_depth,
+        "slo_sec": slo_sec,
+    }
+
+
+def choose_profile(requested: str, duration: float, queue_depth: int = 0, workers: int = 1) -> Dict[str, Any]:
+    """
+    בחירת הפרופיל לעבודה: פרופיל מפורש מכובד כמו שהוא,
+    ו-auto בוחר את האיכותי ביותר שבו ריקון התור (העבודות שממתינות + זו) נכנס ב-SLO
+    """
+    candidates = candidate_profiles(requested)
+    backlog = (queue_depth + 1) / max(workers, 1)
+
+    for profile in candidates:
+        estimated = COST_MODEL.estimate(duration, QUALITY_PROFILES[profile]["shifts"]) * backlog
+        if requested != AUTO or estimated <= LATENCY_SLO_SEC or profile == candidates[-1]:
+            return profile_choice(requested, profile, round(estimated, 1), queue_depth, LATENCY_SLO_SEC)
@@ -0,0 +1,177 @@
+"""
+musicRay - יעדי תוצאות (result sinks) עבור ה-handler
+העלאת סטמים ל-object storage תואם S3 (AWS / MinIO / R2) והחזרת presigned URLs
+"""
+
+import os
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+from cache import link_or_copy
+
+# הגדרות sink מה-environment
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_PREFIX = os.getenv("S3_PREFIX", "musicray/")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # MinIO / moto server / R2
+S3_REGION = os.getenv("S3_REGION")
+PRESIGN_EXPIRES = int(os.getenv("PRESIGN_EXPIRES", str(24 * 3600)))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+LOCAL_SINK_DIR = Path(os.getenv("LOCAL_SINK_DIR", os.path.join(tempfile.gettempdir(), "musicray-output")))
+
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB
+
+
+class UploadBatch:
+    """
+    העלאות של עבודה אחת - רצות ברקע עד שקוראים ל-results()
+    """
+
+    def __init__(self):
+        self._futures: Dict[str, Future] = {}
+
+    def add(self, name: str, future: Future) -> None:
+        self._futures[name] = future
+
+    def results(self) -> Dict[str, dict]:
+        """
+        המתנה לסיום כל ההעלאות והחזרת המידע על כל סטם
+        """
+        return {name: future.result() for name, future in self._futures.items()}
+
+
+class LocalSink:
+    """
+    יעד על מערכת הקבצים המקומית (פיתוח, בדיקות, או network volume)
+    הקבצים מקושרים לתיקייה קבועה כך שהם שורדים את התיקייה הזמנית של האירוע
+    """
+
+    def __init__(self, root: Path = LOCAL_SINK_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def start(self, job_key: str) -> "LocalBatch":
+        job_dir = self.root / job_key
+        job_dir.mkdir(parents=True, exist_ok=True)
+        return LocalBatch(job_dir)
+
+
+class LocalBatch(UploadBatch):
+
+    def __init__(self, job_dir: Path):
+        super().__init__()
+        self.job_dir = job_dir
+
+    def upload(self, name: str, path: Path, content_type: str = "audio/wav") -> None:
+        dst = self.job_dir / Path(path).name
+        link_or_copy(Path(path), dst)
+        future: Future = Future()
+        future.set_result({
+            "path": str(dst),
+            "size_mb": round(os.path.getsize(dst) / 1024 / 1024, 2),
+            "exists": True
+        })
+        self.add(name, future)
+
+
+class S3Sink:
+    """
+    העלאה ל-S3 עם client יחיד ו-connection pool משותף לכל האירועים של ה-worker
+    קבצים גדולים עולים ב-multipart במקביל, ו-URLs חתומים מוחזרים ללקוח
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = S3_PREFIX,
+        endpoint_url: Optional[str] = S3_ENDPOINT_URL,
+        region: Optional[str] = S3_REGION,
+        workers: int = UPLOAD_WORKERS,
+        expires: int = PRESIGN_EXPIRES,
+    ):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.expires = expires
+
+        # כל thread של העלאה מריץ עד 4 חלקי multipart במקביל
+        part_concurrency = 4
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            config=Config(
+                max_pool_connections=workers * part_concurrency,
+                retries={"max_attempts": 5, "mode": "standard"},
+            ),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_CHUNK_SIZE,
+            multipart_chunksize=MULTIPART_CHUNK_SIZE,
+            max_concurrency=part_concurrency,
+        )
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="musicray-upload")
+
+    def start(self, job_key: str) -> "S3Batch":
+        return S3Batch(self, f"{self.prefix}{job_key}/")
+
+    def _exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError:
+            return False
+
+    def _upload(self, path: Path, key: str, content_type: str) -> dict:
+        size = os.path.getsize(path)
+
+        # המפתח נגזר מ-hash התוכן - אם האובייקט כבר קיים אין צורך להעלות שוב
+        if not self._exists(key):
+            self.client.upload_file(
+                str(path),
+                self.bucket,
+                key,
+                ExtraArgs={"ContentType": content_type},
+                Config=self.transfer_config,
+            )
+            print(f"☁️  הועלה: s3://{self.bucket}/{key}")
+
+        url = self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=self.expires,
+        )
+        return {
+            "url": url,
+            "key": key,
+            "size_mb": round(size / 1024 / 1024, 2),
+            "expires_in": self.expires
+        }
+
+
+class S3Batch(UploadBatch):
+
+    def __init__(self, sink: S3Sink, key_prefix: str):
+        super().__init__()
+        self.sink = sink
+        self.key_prefix = key_prefix
+
+    def upload(self, name: str, path: Path, content_type: str = "audio/wav") -> None:
+        key = f"{self.key_prefix}{Path(path).name}"
+        self.add(name, self.sink._pool.submit(self.sink._upload, Path(path), key, content_type))
+
+
+def create_sink():
+    """
+    S3Sink אם הוגדר S3_BUCKET, אחרת LocalSink
+    """
+    if S3_BUCKET:
+        print(f"☁️  Result sink: s3://{S3_BUCKET}/{S3_PREFIX} ({S3_ENDPOINT_URL or 'AWS'})")
+        return S3Sink(S3_BUCKET)
+    print(f"📁 Result sink: local ({LOCAL_SINK_DIR})")
+    return LocalSink()
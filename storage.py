@@ -0,0 +1,300 @@
+"""
+musicRay - ניהול מחזור החיים של תיקיית storage
+מעקב אחרי גודל וגישה אחרונה לכל job, TTL ומכסת דיסק עם פינוי LRU,
+וניקוי ברקע שרץ מחוץ ל-event loop
+"""
+
+import asyncio
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+# מכסת הדיסק של storage (כולל המטמון), זמן חיים של job בלי גישה, ומרווח בין סריקות
+STORAGE_QUOTA_BYTES = int(os.getenv("STORAGE_QUOTA_BYTES", str(50 * 1024 * 1024 * 1024)))  # 50GB
+STORAGE_TTL_SEC = float(os.getenv("STORAGE_TTL_SEC", str(24 * 3600)))
+STORAGE_SWEEP_INTERVAL_SEC = float(os.getenv("STORAGE_SWEEP_INTERVAL_SEC", "300"))
+
+# מקום פנוי מינימלי בדיסק - מתחתיו מפנים jobs גם אם המכסה לא נוצלה
+STORAGE_MIN_FREE_BYTES = int(os.getenv("STORAGE_MIN_FREE_BYTES", str(2 * 1024 * 1024 * 1024)))  # 2GB
+
+# job שמחיקתו מפנה פחות מזה (הסטמים מקושרים למטמון) לא מפונה בלחץ דיסק - אין בזה תועלת
+STORAGE_MIN_FREEABLE_BYTES = 64 * 1024
+
+
+class JobUsage:
+    """
+    גודל וגישה אחרונה של תיקיית job
+    """
+
+    def __init__(self, size_bytes: int, freeable_bytes: int, last_access: float):
+        self.size_bytes = size_bytes
+        self.freeable_bytes = freeable_bytes  # בתים שמתפנים במחיקה (בלי קבצים שמקושרים גם מהמטמון)
+        self.last_access = last_access
+
+
+def _scan_tree(path: Path, seen: Set[Tuple[int, int]]) -> Tuple[int, int, int, float]:
+    """
+    (בתים ייחודיים, גודל, בתים שמתפנים במחיקה, mtime אחרון) של תיקייה
+    hard links נספרים פעם אחת לפי inode על פני כל ה-storage
+    """
+    unique = size = freeable = 0
+    mtime = 0.0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0, 0, 0, 0.0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                sub = _scan_tree(Path(entry.path), seen)
+                unique, size, freeable = unique + sub[0], size + sub[1], freeable + sub[2]
+                mtime = max(mtime, sub[3])
+                continue
+            st = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue  # הקובץ נמחק בזמן הסריקה
+        size += st.st_size
+        mtime = max(mtime, st.st_mtime)
+        if st.st_nlink <= 1:
+            freeable += st.st_size
+        inode = (st.st_dev, st.st_ino)
+        if inode not in seen:
+            seen.add(inode)
+            unique += st.st_size
+    return unique, size, freeable, mtime
+
+
+class StorageManager:
+    """
+    אכיפת TTL ומכסה על תיקיות ה-jobs ב-storage
+    jobs פעילים (pinned) לא נמחקים; תיקיות שמתחילות ב-_ או . (המטמון) נספרות בשימוש אבל לא מפונות
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        quota_bytes: int = STORAGE_QUOTA_BYTES,
+        ttl_sec: float = STORAGE_TTL_SEC,
+        min_free_bytes: int = STORAGE_MIN_FREE_BYTES,
+        on_delete: Optional[Callable[[str], None]] = None,
+        reclaim: Optional[Callable[[int], int]] = None,
+    ):
+        self.root = Path(root)
+        self.quota_bytes = quota_bytes
+        self.ttl_sec = ttl_sec
+        self.min_free_bytes = min_free_bytes
+        self.on_delete = on_delete
+        self.reclaim = reclaim  # פינוי מהמטמון: מקבל כמה בתים לפנות ומחזיר כמה התפנו בפועל
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._pinned: Dict[str, int] = {}
+        self._access: Dict[str, float] = {}
+        self._jobs: Dict[str, JobUsage] = {}
+        self._total_bytes = 0
+        self._stats = {"sweeps": 0, "expired": 0, "evicted": 0, "deleted": 0, "bytes_freed": 0, "cache_bytes_freed": 0}
+        self._last_sweep: Optional[Dict[str, Any]] = None
+
+    def pin(self, job_id: str) -> None:
+        """
+        job פעיל - לא נמחק ע"י ה-TTL או המכסה עד unpin
+        """
+        with self._lock:
+            self._pinned[job_id] = self._pinned.get(job_id, 0) + 1
+            self._access[job_id] = time.time()
+
+    def unpin(self, job_id: str) -> None:
+        with self._lock:
+            count = self._pinned.pop(job_id, 0) - 1
+            if count > 0:
+                self._pinned[job_id] = count
+            self._access[job_id] = time.time()
+
+    def touch(self, job_id: str) -> None:
+        """
+        רישום גישה לקבצי ה-job (הורדה, זרם, תצוגה) - דוחה את ה-TTL ואת הפינוי
+        """
+        with self._lock:
+            self._access[job_id] = time.time()
+
+    def _is_job_dir(self, name: str) -> bool:
+        return not name.startswith(("_", "."))
+
+    def scan(self) -> None:
+        """
+        סריקת storage: גודל וגישה אחרונה לכל job, ושימוש כולל לפי inodes ייחודיים
+        """
+        seen: Set[Tuple[int, int]] = set()
+        jobs: Dict[str, JobUsage] = {}
+        total = 0
+        try:
+            entries = [entry for entry in os.scandir(self.root) if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            entries = []
+        for entry in entries:
+            unique, size, freeable, mtime = _scan_tree(Path(entry.path), seen)
+            total += unique
+            if self._is_job_dir(entry.name):
+                jobs[entry.name] = JobUsage(size, freeable, mtime)
+
+        with self._lock:
+            for job_id, usage in jobs.items():
+                usage.last_access = max(usage.last_access, self._access.get(job_id, 0.0))
+            # רשומות גישה של jobs שכבר לא קיימים (ושאינם pinned) מוסרות
+            for job_id in list(self._access):
+                if job_id not in jobs and job_id not in self._pinned:
+                    del self._access[job_id]
+            self._jobs = jobs
+            self._total_bytes = total
+
+    def _delete(self, job_id: str, force: bool = False) -> int:
+        """
+        מחיקת תיקיית job (רץ ב-thread) - מחזיר את הבתים שהתפנו
+        בלי force - job שהפך ל-pinned מאז הסריקה לא נמחק
+        """
+        with self._lock:
+            if not force and job_id in self._pinned:
+                return 0
+            usage = self._jobs.pop(job_id, None)
+            self._access.pop(job_id, None)
+        shutil.rmtree(self.root / job_id, ignore_errors=True)
+        freed = usage.freeable_bytes if usage is not None else 0
+        with self._lock:
+            self._total_bytes -= freed
+            self._stats["bytes_freed"] += freed
+        if self.on_delete is not None:
+            self.on_delete(job_id)
+        return freed
+
+    def delete(self, job_id: str) -> bool:
+        """
+        מחיקה יזומה של job (DELETE /files) - False אם לא קיים
+        """
+        if not self._is_job_dir(job_id) or not (self.root / job_id).is_dir():
+            return False
+        self._delete(job_id, force=True)
+        with self._lock:
+            self._stats["deleted"] += 1
+        return True
+
+    def _free_bytes(self) -> int:
+        try:
+            return shutil.disk_usage(self.root).free
+        except OSError:
+            return self.min_free_bytes
+
+    def _over_limits(self, free: int) -> int:
+        """
+        כמה בתים צריך לפנות כדי לחזור למכסה ולמקום הפנוי המינימלי (0 - בגבולות)
+        """
+        return max(self._total_bytes - self.quota_bytes, self.min_free_bytes - free, 0)
+
+    def _evict_lru(self, free: int) -> Tuple[int, int, int]:
+        """
+        פינוי jobs מהישן לחדש עד שהמגבלות מתקיימות - (evicted, בתים שהתפנו, מקום פנוי)
+        jobs שמחיקתם כמעט לא מפנה מקום (קבצים מקושרים למטמון) מדולגים
+        """
+        with self._lock:
+            candidates = sorted(
+                (usage.last_access, job_id) for job_id, usage in self._jobs.items()
+                if job_id not in self._pinned and usage.freeable_bytes >= STORAGE_MIN_FREEABLE_BYTES
+            )
+        evicted = freed = 0
+        for _, job_id in candidates:
+            if not self._over_limits(free):
+                break
+            released = self._delete(job_id)
+            freed += released
+            free += released
+            evicted += 1
+        return evicted, freed, free
+
+    def sweep(self) -> Dict[str, Any]:
+        """
+        סריקה, מחיקת jobs שעבר ה-TTL שלהם, ופינוי LRU עד שהשימוש בתוך המכסה והדיסק לא מלא
+        אם פינוי jobs לא מספיק - פינוי מהמטמון (reclaim), וסבב נוסף על jobs שקבציהם כבר לא מקושרים למטמון
+        """
+        with self._sweep_lock:
+            start = time.time()
+            self.scan()
+            now = time.time()
+            with self._lock:
+                candidates = sorted(
+                    ((usage.last_access, job_id) for job_id, usage in self._jobs.items() if job_id not in self._pinned)
+                )
+
+            expired = freed = cache_freed = 0
+            for last_access, job_id in candidates:
+                if now - last_access > self.ttl_sec:
+                    freed += self._delete(job_id)
+                    expired += 1
+
+            # מהישן לחדש - עד שהמכסה והמקום הפנוי בדיסק מתקיימים
+            evicted, released, free = self._evict_lru(self._free_bytes())
+            freed += released
+
+            need = self._over_limits(free)
+            if need and self.reclaim is not None:
+                cache_freed = self.reclaim(need)
+                # קבצי jobs שהיו מקושרים לרשומות שפונו ניתנים עכשיו לפינוי
+                self.scan()
+                more, released, free = self._evict_lru(self._free_bytes())
+                evicted += more
+                freed += released
+
+            with self._lock:
+                self._stats["sweeps"] += 1
+                self._stats["expired"] += expired
+                self._stats["evicted"] += evicted
+                self._stats["cache_bytes_freed"] += cache_freed
+                self._last_sweep = {
+                    "at": start,
+                    "duration_sec": round(time.time() - start, 3),
+                    "expired": expired,
+                    "evicted": evicted,
+                    "bytes_freed": freed,
+                    "cache_bytes_freed": cache_freed,
+                }
+            if expired or evicted or cache_freed:
+                print(f"🧹 ניקוי storage: {expired} פגי תוקף, {evicted} פונו (LRU), {freed / 1024 / 1024:.1f}MB, "
+                      f"מטמון {cache_freed / 1024 / 1024:.1f}MB")
+            return self._last_sweep
+
+    async def run_sweeper(self, interval: float = STORAGE_SWEEP_INTERVAL_SEC) -> None:
+        """
+        לולאת ניקוי ברקע - כל סריקה רצה ב-thread כדי לא לחסום את ה-event loop
+        """
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                print(f"שגיאה בניקוי storage: {str(e)}")
+            await asyncio.sleep(interval)
+
+    def usage(self) -> Dict[str, Any]:
+        """
+        מדדי שימוש: בתים, מכסה, מספר jobs, pinned, מקום פנוי ותוצאות הניקוי
+        """
+        with self._lock:
+            jobs = dict(self._jobs)
+            pinned = len(self._pinned)
+            stats = dict(self._stats)
+            last_sweep = self._last_sweep
+            total = self._total_bytes
+        oldest = min((usage.last_access for usage in jobs.values()), default=None)
+        return {
+            "total_bytes": total,
+            "quota_bytes": self.quota_bytes,
+            "quota_used": round(total / self.quota_bytes, 4) if self.quota_bytes else None,
+            "jobs": len(jobs),
+            "jobs_bytes": sum(usage.size_bytes for usage in jobs.values()),
+            "pinned_jobs": pinned,
+            "oldest_access_age_sec": round(time.time() - oldest, 1) if oldest else None,
+            "disk_free_bytes": self._free_bytes(),
+            "min_free_bytes": self.min_free_bytes,
+            "ttl_sec": self.ttl_sec,
+            "last_sweep": last_sweep,
+            **stats,
+        }
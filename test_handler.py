@@ -29,25 +29,22 @@ def test_handler_local():
     
     try:
         # קריאה ישירה לפונקציות הפנימיות
-        from handler import convert_to_wav, separate_audio, analyze_audio
+        from handler import decode_audio, separate_audio, analyze_audio
         import tempfile
         
         with tempfile.TemporaryDirectory() as temp_dir:
             temp_path = Path(temp_dir)
-            wav_file = temp_path / "input.wav"
             stems_dir = temp_path / "stems"
             stems_dir.mkdir()
             
-            print(f"🔄 ממיר ל-WAV...")
-            if not convert_to_wav(str(test_audio_path), str(wav_file)):
-                print("❌ המרה נכשלה")
-                return
+            print(f"🔄 מפענח לזיכרון...")
+            audio = decode_audio(test_audio_path)
             
             print(f"🎯 מפריד סטמים...")
-            stem_files = separate_audio(str(wav_file), str(stems_dir))
+            stem_files = separate_audio(audio, str(stems_dir))
             
             print(f"📊 מנתח שמע...")
-            analysis = analyze_audio(str(wav_file))
+            analysis = analyze_audio(audio)
             
             print("✅ בדיקה הושלמה בהצלחה!")
             print(f"🎵 סטמים שנוצרו: {list(stem_files.keys())}")
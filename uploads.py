@@ -0,0 +1,185 @@
+"""
+musicRay - קליטת העלאות בזרימה
+גוף ה-multipart מפוענח תוך כדי קבלה וקובץ השמע נכתב ישר לתיקיית ה-job (בלי קובץ זמני של Starlette),
+כך שהעלאה גדולה מדי או מסוג לא נתמך נדחית לפני שנכתבה לדיסק
+"""
+
+import asyncio
+import hashlib
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import Request
+
+from metrics import UPLOAD_BYTES
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# מקום לשדות הטופס ול-headers של ה-multipart מעבר לקובץ עצמו (לבדיקת Content-Length)
+FORM_OVERHEAD_BYTES = 64 * 1024
+MAX_FIELD_SIZE = 1024
+
+
+class UploadError(Exception):
+    """
+    העלאה שנדחתה - status_code ו-detail לתשובת ה-HTTP
+    """
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class ReceivedUpload:
+    """
+    תוצאת הקליטה: שדות הטופס, שם הקובץ המקורי, הנתיב שנכתב, גודל ו-SHA-256
+    """
+
+    def __init__(self, fields: Dict[str, str], filename: str, path: Path, size: int, content_hash: str):
+        self.fields = fields
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.content_hash = content_hash
+
+
+def _too_large(max_file_size: int) -> UploadError:
+    return UploadError(413, f"הקובץ גדול מדי (מקסימום {max_file_size // (1024 * 1024)}MB)")
+
+
+def check_content_length(request: Request, max_file_size: int) -> None:
+    """
+    דחייה לפי Content-Length - לפני קריאת בית אחד מהגוף
+    """
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > max_file_size + FORM_OVERHEAD_BYTES:
+        raise _too_large(max_file_size)
+
+
+def _part_info(headers: Dict[bytes, bytes]) -> Tuple[str, Optional[str]]:
+    """
+    שם השדה ושם הקובץ (None לשדה רגיל) מתוך Content-Disposition
+    """
+    _, options = parse_options_header(headers.get(b"content-disposition", b""))
+    name = options.get(b"name", b"").decode("utf-8", "replace")
+    filename = options.get(b"filename")
+    return name, filename.decode("utf-8", "replace") if filename is not None else None
+
+
+async def receive_upload(
+    request: Request,
+    dest_dir: Path,
+    max_file_size: int,
+    extensions: Tuple[str, ...],
+    file_field: str = "file",
+) -> ReceivedUpload:
+    """
+    קליטת טופס multipart בזרימה: קובץ השמע נכתב ל-dest_dir/input{ext} תוך חישוב SHA-256,
+    הסיומת נבדקת ב-headers של החלק לפני שנכתב ממנו משהו, והגודל נאכף לכל chunk
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise UploadError(400, "הבקשה חייבת להיות multipart/form-data")
+
+    # אירועי ה-parser נאספים ומטופלים אחרי כל chunk - הכתיבה לדיסק לא חוסמת את ה-event loop
+    events: List[Tuple[str, Any]] = []
+    header: Dict[str, bytes] = {"field": b"", "value": b""}
+    headers: Dict[bytes, bytes] = {}
+
+    def on_part_begin() -> None:
+        headers.clear()
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        header["field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        header["value"] += data[start:end]
+
+    def on_header_end() -> None:
+        headers[header["field"].lower()] = header["value"]
+        header["field"] = header["value"] = b""
+
+    def on_headers_finished() -> None:
+        events.append(("start", dict(headers)))
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        events.append(("data", data[start:end]))
+
+    def on_part_end() -> None:
+        events.append(("end", None))
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    fields: Dict[str, str] = {}
+    upload: Optional[ReceivedUpload] = None
+    part: Optional[Dict[str, Any]] = None
+    digest = hashlib.sha256()
+    out = None
+
+    async def handle_events() -> None:
+        nonlocal part, upload, out
+        for kind, payload in events:
+            if kind == "start":
+                name, filename = _part_info(payload)
+                if filename is None:
+                    part = {"kind": "field", "name": name, "data": b""}
+                elif name == file_field and upload is None:
+                    # בדיקת סוג הקובץ לפי ה-headers של החלק - לפני שנכתב ממנו משהו
+                    if not filename.lower().endswith(extensions):
+                        raise UploadError(400, "פורמט קובץ לא נתמך. השתמש ב-MP3, WAV, FLAC או M4A")
+                    path = Path(dest_dir) / f"input{Path(filename).suffix.lower()}"
+                    out = await asyncio.to_thread(open, path, "wb")
+                    upload = ReceivedUpload(fields, filename, path, 0, "")
+                    part = {"kind": "file"}
+                else:
+                    part = {"kind": "skip"}  # קבצים נוספים לא נשמרים
+            elif kind == "data" and part is not None:
+                if part["kind"] == "file":
+                    upload.size += len(payload)
+                    if upload.size > max_file_size:
+                        raise _too_large(max_file_size)
+                    digest.update(payload)
+                    UPLOAD_BYTES.inc(len(payload))
+                    await asyncio.to_thread(out.write, payload)
+                elif part["kind"] == "field":
+                    part["data"] += payload
+                    if len(part["data"]) > MAX_FIELD_SIZE:
+                        raise UploadError(400, f"שדה {part['name']} ארוך מדי")
+            elif kind == "end" and part is not None:
+                if part["kind"] == "field":
+                    fields[part["name"]] = part["data"].decode("utf-8", "replace")
+                elif part["kind"] == "file":
+                    await asyncio.to_thread(out.close)
+                    out = None
+                part = None
+        events.clear()
+
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            await handle_events()
+        parser.finalize()
+        await handle_events()
+    finally:
+        if out is not None:
+            await asyncio.to_thread(out.close)
+
+    if upload is None:
+        raise UploadError(400, f"חסר קובץ בשדה {file_field}")
+    if part is not None:
+        raise UploadError(400, "גוף ה-multipart נקטע באמצע")
+    upload.content_hash = digest.hexdigest()
+    return upload